@@ -1,46 +1,139 @@
+import hashlib
+import json
 import os
+import uuid
 
-from cs50 import SQL
-from flask import Flask, flash, redirect, render_template, request, session, url_for
-from flask_session import Session
-from tempfile import mkdtemp
+from datetime import datetime, timezone
+from flask import Flask, Response, flash, jsonify, redirect, render_template, request, session, stream_with_context, url_for
+from functools import partial
 from werkzeug.exceptions import default_exceptions
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from helpers import apology, login_required, lookup, usd
+from charts import INTERVALS, ChartCache, polyline
+from database import Database
+from fragments import FragmentCache
+from helpers import BROWSE, TRADE, RateLimited, apology, bar_store, cache_control, env_flag, login_required, lookup, lookup_many, quote_cache, quote_provider, usd
+from metrics import INSTRUMENTED, METRICS, Instrumented, label, registry
+from migrations import upgrade
+from passwords import PasswordsBusy, hasher
+from pnl import LedgerCache, positions, totals
+from repository import History, Portfolio, Users
+from sessions import SQLiteSessionInterface
+from refresher import PRICE_REFRESH, PriceRefresher, record_view
+from scheduler import scheduler
+from snapshots import SnapshotStore
+import trades
 
 # Personaly added in
 from passlib.apps import custom_app_context as pwd_context
 
-# Ensure environment variable is set
-if not os.environ.get("API_KEY"):
+# Ensure environment variable is set, if the quote provider needs it
+if quote_provider.needs_api_key and not os.environ.get("API_KEY"):
     raise RuntimeError("API_KEY not set")
 
+# In production templates are compiled once at startup and never reloaded
+PRODUCTION = env_flag("PRODUCTION")
+
 # Configure application
 app = Flask(__name__)
 
-# Ensure templates are auto-reloaded
-app.config["TEMPLATES_AUTO_RELOAD"] = True
+# Ensure templates are auto-reloaded, except in production
+app.config["TEMPLATES_AUTO_RELOAD"] = not PRODUCTION
 
-# Ensure responses aren't cached
+# Ensure responses aren't cached, unless their route sets a cache policy of its own
 @app.after_request
 def after_request(response):
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
+    if INSTRUMENTED:
+        label(request.url_rule.rule if request.url_rule else "unmatched")
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
     return response
 
 # Custom filter
 app.jinja_env.filters["usd"] = usd
 
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_FILE_DIR"] = mkdtemp()
+# Compile every template up front, so no request pays for it
+if PRODUCTION:
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+# Configure SQLite database, with a WAL-mode connection per thread
+db = Database("finance.db")
+
+# Bring the schema up to date
+upgrade(db)
+
+# Spend the upstream quote quota from one bucket shared by every worker process
+scheduler.share(db)
+
+# Configure session to use the database (instead of signed cookies), shared by every worker process;
+# sessions are only written when they change
 app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+app.session_interface = SQLiteSessionInterface(app, db, permanent=False)
+
+# Named, prepared queries used by the routes
+users = Users(db)
+portfolios = Portfolio(db)
+histories = History(db)
+
+# Each user's holdings and valuation, kept up to date between requests
+snapshots = SnapshotStore(users, portfolios, histories)
+
+# Each user's cost basis and realized P&L, recomputed from history after they trade
+ledgers = LedgerCache(users, histories)
+
+# Each user's portfolio value over time, redrawn after they trade
+charts = ChartCache(users, histories)
+
+# Rendered portfolio rows and history pages, dropped when their user trades
+fragments = FragmentCache()
+
+# Optionally time every request, for /metrics and the Server-Timing header
+if INSTRUMENTED:
+    app.wsgi_app = Instrumented(app)
+    for name, source in [("db", db.metrics), ("snapshots", snapshots.metrics), ("fragments", fragments.metrics),
+                         ("passwords", hasher.metrics)] + ([("bars", bar_store.metrics)] if bar_store else []):
+        registry.source(name, source)
+
+# Optionally keep held symbols' quotes warm in the background
+if PRICE_REFRESH:
+    PriceRefresher(portfolios).start()
+
+# Transactions shown per history page, and fetched per query when streaming all of them
+HISTORY_PAGE_SIZE = 100
+HISTORY_STREAM_CHUNK = 500
+
+# Most symbols /api/quote looks up at once
+API_QUOTE_LIMIT = 100
+
+# Price versions are per process, so ETags built from them name the process too
+INSTANCE = uuid.uuid4().hex[:8]
+
+
+@app.cli.command("migrate")
+def migrate():
+    """Apply pending schema migrations"""
+    print(f"schema version {upgrade(db)}")
+
+
+@app.cli.command("check-snapshots")
+def check_snapshots():
+    """Replay every user's history and compare it with their holdings and cash"""
+    mismatches = [mismatch for user_id in users.ids() for mismatch in snapshots.check(user_id)]
+    for mismatch in mismatches:
+        print(mismatch)
+    if mismatches:
+        raise SystemExit(1)
+    print("snapshots consistent")
+
+
+@app.cli.command("session-cleanup")
+def session_cleanup():
+    """Delete expired sessions"""
+    print(f"deleted {app.session_interface.cleanup()} expired sessions")
 
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///finance.db")
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -61,15 +154,21 @@ def login():
             return apology("must provide password", 403)
 
         # Query database for username
-        rows = db.execute("SELECT * FROM users WHERE username = :username",
-                          username=request.form.get("username"))
+        user = users.by_username(request.form.get("username"))
 
-        # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], request.form.get("password")):
-            return apology("invalid username and/or password", 403)
+        # Ensure username exists and password is correct, checked off the request thread
+        try:
+            if not user or not hasher.check(user.hash, request.form.get("password")):
+                return apology("invalid username and/or password", 403)
+        except PasswordsBusy:
+            return apology("too many logins, try again shortly", 503)
+
+        # Upgrade hashes made with an older method or cost, now the password is known
+        if hasher.needs_rehash(user.hash):
+            hasher.rehash(request.form.get("password"), partial(users.set_hash, user.id))
 
         # Remember which user has logged in
-        session["user_id"] = rows[0]["id"]
+        session["user_id"] = user.id
 
         # Redirect user to home page
         return redirect("/")
@@ -102,17 +201,16 @@ def register():
         elif request.form.get("password") != request.form.get("confirmation"):
             return apology("passwords must match")
 
-        # [2][3] Insert username and hash into database, and place that info into an array
-        result = db.execute("INSERT INTO users (username, hash) VALUES (:username, :_hash)",
-                            username=request.form.get("username"),
-                            _hash=generate_password_hash(request.form.get("password")))
-        if not result:
+        # [2][3] Insert username and hash into database, which returns the new user's id
+        try:
+            _id = users.create(request.form.get("username"), hasher.hash(request.form.get("password")))
+        except PasswordsBusy:
+            return apology("too many registrations, try again shortly", 503)
+        if not _id:
             return apology("username taken, choose another")
 
         # [4] Keep user logged in during session
-        _id = db.execute("SELECT id FROM users WHERE username = :username",
-                         username=request.form.get("username"))
-        session["user_id"] = _id[0]["id"]
+        session["user_id"] = _id
 
         # [5][6][7] Take user back to main page
         return redirect("/")
@@ -127,31 +225,16 @@ def register():
 def index():
     """Show portfolio of stocks"""
 
-    # Initialize the grand total starting with the user's current cash value
-    cash = db.execute("SELECT cash FROM users WHERE id=:_id", _id=session["user_id"])
-    grand_total = cash[0]["cash"]
-
-    # List each stock symbol and its quantity of shares from portfolio table
-    symbol_shares = db.execute("SELECT symbol, shares FROM portfolio WHERE id=:_id",
-                               _id=session["user_id"])
-
-    # Update stock price and add to grand total
-    for row in symbol_shares:
-        symbol = row["symbol"]
-        shares = row["shares"]
-        stock = lookup(symbol)
-        total = stock["price"] * shares
-        db.execute("UPDATE portfolio SET price=:price, total=:total WHERE symbol=:symbol",
-                   price=usd(stock["price"]), total=usd(total), symbol=symbol)
-        # Add stock value to the grand total
-        grand_total += total
+    # Re-price only the holdings whose quote changed, at their last stored price when there is no quote;
+    # nothing is written back to the portfolio table
+    snapshot = priced_snapshot(session["user_id"])
 
-    # Array of all portfolio data
-    portfolio = db.execute("SELECT * FROM portfolio WHERE id=:_id", _id=session["user_id"])
+    # Rows are rendered once per version of the user's holdings and prices
+    rows = fragments.get(session["user_id"], ("portfolio", snapshot.version, snapshot.price_version),
+                         lambda: render_template("portfolio_rows.html", portfolio=snapshot.holdings.values()))
 
     # [9] helpers.py does not provide a dictionary with three keys as stated
-    return render_template("index.html", portfolio=portfolio, cash=usd(cash[0]["cash"]),
-                           grand_total=usd(grand_total))
+    return render_template("index.html", rows=rows, cash=snapshot.cash, grand_total=snapshot.total)
 
 
 @app.route("/quote", methods=["GET", "POST"])
@@ -162,12 +245,14 @@ def quote():
     if request.method == "POST":
 
         # Recieve stock symbol from quote form
-        quote = lookup(request.form.get("symbol"))
+        try:
+            quote = lookup(request.form.get("symbol"))
+        except RateLimited:
+            return apology("too many quotes, try again shortly", 429)
         if not quote:
             return apology("stock symbol not found")
 
-        # Convert price to USD format
-        quote['price'] = usd(quote['price'])
+        # Price is formatted by the usd filter, since quote is shared through the cache
         return render_template("quote.html", quote=quote)
 
     else:
@@ -182,8 +267,11 @@ def buy():
 
     if request.method == "POST":
 
-        # Retrieve stock symbol
-        stock = lookup(request.form.get("symbol"))
+        # Retrieve stock symbol, with a fresh price for trade execution
+        try:
+            stock = lookup(request.form.get("symbol"), fresh=True, priority=TRADE)
+        except RateLimited:
+            return apology("too many quotes, try again shortly", 429)
         if not stock:
             return apology("stock symbol not found")
 
@@ -195,31 +283,13 @@ def buy():
         except:
             return apology("must be a positive whole number")
 
-        # Grab user funds
-        cash = db.execute("SELECT cash FROM users Where id=:_id", _id=session["user_id"])
-
-        # Check if they're sufficient
-        if stock["price"] * shares > float(cash[0]["cash"]):
-            return apology("insufficient funds", 403)
-
-        # [11] Check if stock exists within portfolio
-        holdings = db.execute("SELECT shares FROM portfolio WHERE id=:_id AND symbol=:symbol",
-                              _id=session["user_id"], symbol=stock["symbol"])
-        # Update if stock exists
-        if holdings:
-            db.execute("UPDATE portfolio SET price= price+:price, shares= shares+:shares WHERE id=:_id AND symbol=:symbol",
-                       price=stock["price"], shares=shares, _id=session["user_id"], symbol=stock["symbol"])
-            db.execute("INSERT INTO history (symbol, shares, price, total, id) VALUES (:symbol, :shares, :price, :total, :_id)",
-                       symbol=stock["symbol"], shares=shares, price=stock["price"], total=stock["price"]*shares, _id=session["user_id"])
-        # Insert if it doesn't
-        else:
-            db.execute("INSERT INTO portfolio (symbol, shares, price, total, id) VALUES (:symbol, :shares, :price, :total, :_id)",
-                       symbol=stock["symbol"], shares=shares, price=stock["price"], total=stock["price"]*shares, _id=session["user_id"])
-            db.execute("INSERT INTO history (symbol, shares, price, total, id) VALUES (:symbol, :shares, :price, :total, :_id)",
-                       symbol=stock["symbol"], shares=shares, price=stock["price"], total=stock["price"]*shares, _id=session["user_id"])
-
-        # Update user's funds
-        db.execute("UPDATE users SET cash= cash-:cost WHERE id=:_id", cost=stock["price"]*shares, _id=session["user_id"])
+        # [11] Take the cost from user's funds and add the stock to their portfolio in one transaction
+        try:
+            version = trades.buy(db, session["user_id"], stock["symbol"], shares, stock["price"])
+        except trades.TradeError as e:
+            return apology(e.message, e.code)
+        snapshots.apply_trade(session["user_id"], version, stock["symbol"], shares, stock["price"])
+        fragments.invalidate(session["user_id"])
 
         return redirect("/")
 
@@ -234,11 +304,15 @@ def sell():
 
     if request.method == "POST":
 
-        # Retrieve stock symbol
+        # Retrieve stock symbol, with a fresh price for trade execution
         try:
-            stock = lookup(request.form.get("symbol"))
+            stock = lookup(request.form.get("symbol"), fresh=True, priority=TRADE)
+        except RateLimited:
+            return apology("too many quotes, try again shortly", 429)
         except:
             return apology("no stocks held")
+        if not stock:
+            return apology("stock symbol not found")
 
         # Retrieve number of shares
         try:
@@ -248,37 +322,22 @@ def sell():
         except:
             return apology("must be a positive whole number")
 
-        # Check if there are shares in portfolio and if there are enough
-        holdings = db.execute("SELECT shares FROM portfolio WHERE id=:_id AND symbol=:symbol",
-                              _id=session["user_id"], symbol=stock["symbol"])
-        if not holdings:
-            return apology("stock is not in portfolio", 403)
-        if shares > holdings[0]["shares"]:
-            return apology("quantity of shares are insufficient")
-
-        # Update portfolio
-        db.execute("UPDATE portfolio SET shares= shares-:shares WHERE id=:_id AND symbol=:symbol",
-                   shares=shares, _id=session["user_id"], symbol=stock["symbol"])
-
-        # Add transaction into history, outgoing transactions are negative
-        db.execute("INSERT INTO history (symbol, shares, price, total, id) VALUES (:symbol, :shares, :price, :total, :_id)",
-                   symbol=stock["symbol"], shares=-shares, price=stock["price"], total=stock["price"]*shares, _id=session["user_id"])
-
-        # If no shares of stock are owned, delete stock data from portfolio
-        if holdings[0]["shares"] == shares:
-            db.execute("DELETE FROM portfolio WHERE id=:_id AND symbol=:symbol", _id=session["user_id"], symbol=stock["symbol"])
-
-        # Update user's funds
-        db.execute("UPDATE users SET cash= cash+:revenue WHERE id=:_id", revenue=stock["price"]*shares, _id=session["user_id"])
+        # Take the shares from user's portfolio and add the revenue to their funds in one transaction
+        try:
+            version = trades.sell(db, session["user_id"], stock["symbol"], shares, stock["price"])
+        except trades.TradeError as e:
+            return apology(e.message, e.code)
+        snapshots.apply_trade(session["user_id"], version, stock["symbol"], -shares, stock["price"])
+        fragments.invalidate(session["user_id"])
 
         return redirect("/")
 
     else:
 
         # Grab list of stocks
-        stocks = db.execute("SELECT symbol FROM portfolio WHERE id=:_id", _id=session["user_id"])
+        symbols = portfolios.symbols(session["user_id"])
 
-        return render_template("sell.html", stocks=stocks)
+        return render_template("sell.html", symbols=symbols)
 
 
 @app.route("/history")
@@ -286,15 +345,211 @@ def sell():
 def history():
     """Show history of transactions"""
 
-    history = db.execute("SELECT symbol, shares, price, total, date_time FROM history WHERE id=:_id",
-                         _id=session["user_id"])
+    # Filters by symbol and date range (YYYY-MM-DD, inclusive) are applied in SQL
+    filters = {key: request.args.get(key) for key in ["symbol", "start", "end"] if request.args.get(key)}
+    if "symbol" in filters:
+        filters["symbol"] = filters["symbol"].upper()
+
+    # Stream every matching transaction as it comes off the database
+    if request.args.get("stream"):
+        context = {"history": history_rows(session["user_id"], filters), "filters": filters}
+        app.update_template_context(context)
+        return Response(stream_with_context(app.jinja_env.get_template("history.html").generate(context)))
+
+    # Otherwise show one page, continuing from the (date_time, h_id) key the previous page ended at
+    before = None
+    if request.args.get("before_time") and request.args.get("before_id"):
+        try:
+            before = (request.args.get("before_time"), int(request.args.get("before_id")))
+        except ValueError:
+            return apology("invalid page")
+
+    # Each page is rendered once per version of the user's history, which only trades change
+    _, version = users.cash(session["user_id"])
+    page = fragments.get(session["user_id"], ("history", version, tuple(sorted(filters.items())), before),
+                         lambda: history_page(session["user_id"], filters, before))
+
+    return render_template("history.html", page=page, filters=filters)
 
-    # Format price into USD
-    for stock in history:
-        stock["price"] = usd(stock["price"])
-        stock["total"] = usd(stock["total"])
 
-    return render_template("history.html", history=history)
+def history_page(user_id, filters, before):
+    """Render one page of user's transactions matching filters, starting after before."""
+
+    # Fetch one extra row to learn whether there is a next page; prices and totals are formatted by the usd filter
+    history = histories.page(user_id, before=before, limit=HISTORY_PAGE_SIZE + 1, **filters)
+    next_page = None
+    if len(history) > HISTORY_PAGE_SIZE:
+        history = history[:HISTORY_PAGE_SIZE]
+        next_page = url_for("history", before_time=history[-1].date_time, before_id=history[-1].h_id, **filters)
+
+    return render_template("history_page.html", history=history, next_page=next_page)
+
+
+def history_rows(user_id, filters):
+    """Yield every one of user's transactions matching filters, newest first, a keyset page at a time."""
+
+    before = None
+    while True:
+        rows = histories.page(user_id, before=before, limit=HISTORY_STREAM_CHUNK, **filters)
+        yield from rows
+        if len(rows) < HISTORY_STREAM_CHUNK:
+            return
+        before = (rows[-1].date_time, rows[-1].h_id)
+
+
+@app.route("/performance")
+@login_required
+def performance():
+    """Show cost basis and profit and loss of every stock traded"""
+
+    # FIFO unless average cost is asked for
+    method = "average" if request.args.get("method") == "average" else "fifo"
+    report, total = performance_report(session["user_id"], priced_snapshot(session["user_id"]))
+    return render_template("performance.html", positions=report, total=total, method=method)
+
+
+@app.route("/api/performance")
+@login_required
+@cache_control(private=True, no_cache=True)
+def api_performance():
+    """Return cost basis and profit and loss of every stock traded, under both FIFO and average cost, as JSON"""
+
+    # Depends only on the user's trades and the prices in their snapshot
+    snapshot = priced_snapshot(session["user_id"])
+    def build():
+        report, total = performance_report(session["user_id"], snapshot)
+        return {"positions": [position._asdict() for position in report], "totals": total}
+    return conditional_json(f"performance-{INSTANCE}-{session['user_id']}-{snapshot.version}-{snapshot.price_version}", build)
+
+
+def performance_report(user_id, snapshot):
+    """Return user's Positions and their totals, held stocks valued as in their snapshot."""
+
+    # Value held stocks at the same prices as the user's snapshot, others at their last traded price
+    prices = {symbol: holding.price for symbol, holding in snapshot.holdings.items()}
+    report = positions(ledgers.get(user_id), prices)
+    return report, totals(report)
+
+
+@app.route("/chart")
+@login_required
+def chart():
+    """Chart portfolio value over time"""
+
+    interval = request.args.get("interval") if request.args.get("interval") in INTERVALS else "day"
+    drawn = charts.get(session["user_id"], interval)
+    start, end = (datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%d %H:%M UTC") for t in (drawn.times[0], drawn.times[-1]))
+    return render_template("chart.html", chart=drawn, intervals=INTERVALS, interval=interval, start=start, end=end,
+                           points=polyline(drawn.total, 800, 300))
+
+
+@app.route("/api/chart")
+@login_required
+@cache_control(private=True, no_cache=True)
+def api_chart():
+    """Return portfolio value over time as JSON, with times in seconds since the epoch"""
+
+    interval = request.args.get("interval") if request.args.get("interval") in INTERVALS else "day"
+    drawn = charts.get(session["user_id"], interval)
+    return conditional_json(f"chart-{INSTANCE}-{session['user_id']}-{drawn.version}-{drawn.period}-{drawn.price_version}-"
+                            f"{interval}", lambda: drawn._asdict())
+
+
+@app.route("/metrics")
+def metrics():
+    """Serve request timings and cache counters in Prometheus text format, if METRICS is set"""
+
+    if not METRICS:
+        return apology("metrics are off", 404)
+    return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/api/portfolio")
+@login_required
+@cache_control(private=True, no_cache=True)
+def api_portfolio():
+    """Return cash, holdings and grand total as JSON"""
+
+    snapshot = priced_snapshot(session["user_id"])
+    def build():
+        return {"cash": snapshot.cash, "total": snapshot.total,
+                "holdings": [holding._asdict() for holding in snapshot.holdings.values()]}
+    return conditional_json(f"portfolio-{INSTANCE}-{session['user_id']}-{snapshot.version}-{snapshot.price_version}", build)
+
+
+@app.route("/api/quote")
+@login_required
+@cache_control(private=True)
+def api_quote():
+    """Return quotes for comma separated symbols as JSON, with the reason for any that couldn't be quoted"""
+
+    symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in request.args.get("symbols", "").split(",")
+                                 if symbol.strip()))
+    if not symbols:
+        return jsonify(error="must provide symbols"), 400
+    if len(symbols) > API_QUOTE_LIMIT:
+        return jsonify(error=f"at most {API_QUOTE_LIMIT} symbols"), 400
+
+    quotes, errors = lookup_many(symbols, priority=BROWSE)
+    answer = {"quotes": {symbol: {"symbol": quote["symbol"], "price": quote["price"]} for symbol, quote in quotes.items()},
+              "errors": errors}
+
+    # Tagged by content, so a changed error or price always changes the tag;
+    # clients may reuse the answer until the first of its quotes expires
+    digest = hashlib.sha1(json.dumps(answer, sort_keys=True).encode()).hexdigest()[:16]
+    response = conditional_json(f"quote-{digest}", lambda: answer)
+    response.cache_control.max_age = int(min([quote_cache.expires_in(symbol) for symbol in quotes], default=0))
+    return response
+
+
+@app.route("/api/history")
+@login_required
+@cache_control(private=True, no_cache=True)
+def api_history():
+    """Return a page of transactions, newest first, as JSON, with the URL of the next page"""
+
+    filters = {key: request.args.get(key) for key in ["symbol", "start", "end"] if request.args.get(key)}
+    if "symbol" in filters:
+        filters["symbol"] = filters["symbol"].upper()
+    before = None
+    if request.args.get("before_time") and request.args.get("before_id"):
+        try:
+            before = (request.args.get("before_time"), int(request.args.get("before_id")))
+        except ValueError:
+            return jsonify(error="invalid page"), 400
+
+    # History only changes when the user trades
+    _, version = users.cash(session["user_id"])
+    def build():
+        history = histories.page(session["user_id"], before=before, limit=HISTORY_PAGE_SIZE + 1, **filters)
+        next_page = None
+        if len(history) > HISTORY_PAGE_SIZE:
+            history = history[:HISTORY_PAGE_SIZE]
+            next_page = url_for("api_history", before_time=history[-1].date_time, before_id=history[-1].h_id, **filters)
+        return {"transactions": [transaction._asdict() for transaction in history], "next": next_page}
+    return conditional_json(f"history-{session['user_id']}-{version}", build)
+
+
+def priced_snapshot(user_id):
+    """Return user's Snapshot after refreshing the quotes of everything they hold, as the index page does."""
+    symbols = list(snapshots.get(user_id).holdings)
+    lookup_many(symbols, stale=True)
+    record_view(symbols)
+    return snapshots.get(user_id)
+
+
+def conditional_json(etag, build):
+    """
+    Answer 304 Not Modified if the client already has etag, otherwise build()
+    as JSON, tagged with etag. Per-user answers name the user in etag, since
+    another user of the same browser sends the same URL.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    return response
 
 
 @app.route("/logout")
@@ -0,0 +1,318 @@
+"""
+Local store of intraday bars
+
+Every Alpha Vantage quote comes with the symbol's latest 1-minute bars, which
+are kept here instead of being thrown away. Each symbol has a directory
+under BAR_DIR holding one file per column (timestamp, open, high, low,
+close, volume), in timestamp order with no timestamp twice, and reads are
+memory-mapped slices of those files. New bars are appended, except that the
+latest bar is overwritten by a later copy, its minute having still been
+forming when it was first stored.
+
+Bars older than BAR_RETENTION_DAYS are dropped as new ones come in, and once
+the store outgrows BAR_MAX_BYTES the symbols updated least recently are
+dropped whole. Timestamps are seconds since the epoch, converted from
+Alpha Vantage's US/Eastern times so they compare with history's UTC ones.
+Directories without a format file hold the first layout's timestamps, the
+Eastern wall-clock times read as UTC, and are converted when first read.
+
+Writes are serialized within a process only.
+"""
+
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from collections import namedtuple
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+# Bar store settings; the store is off unless BAR_DIR is set, since keeping bars means reading
+# each quote's whole series instead of its first two lines
+BAR_DIR = os.getenv("BAR_DIR", "")
+BAR_RETENTION_DAYS = float(os.getenv("BAR_RETENTION_DAYS", 30))
+BAR_MAX_BYTES = int(os.getenv("BAR_MAX_BYTES", 256 * 1024 * 1024))
+
+# Column names and types, one file each
+COLUMNS = {
+    "time": np.int64,
+    "open": np.float64,
+    "high": np.float64,
+    "low": np.float64,
+    "close": np.float64,
+    "volume": np.int64
+}
+BAR_BYTES = sum(np.dtype(dtype).itemsize for dtype in COLUMNS.values())
+
+# Version of the files' layout, kept in each symbol's format file
+FORMAT = 2
+
+# Alpha Vantage's time zone
+EASTERN = ZoneInfo("America/New_York")
+
+Bars = namedtuple("Bars", COLUMNS)
+
+
+def from_rows(rows):
+    """Return Bars of CSV rows of timestamp, open, high, low, close and volume, skipping rows that don't parse."""
+
+    parsed = []
+    for row in rows:
+        try:
+            timestamp = int(datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S").replace(tzinfo=EASTERN).timestamp())
+            parsed.append((timestamp, *map(float, row[1:5]), int(float(row[5]))))
+        except (ValueError, IndexError):
+            continue
+    return Bars(*(np.array([row[i] for row in parsed], dtype=dtype) for i, dtype in enumerate(COLUMNS.values())))
+
+
+def from_naive(times):
+    """Return seconds since the epoch of times holding US/Eastern wall-clock times read as UTC."""
+    hours, index = np.unique(times // 3600, return_inverse=True)
+    offsets = [datetime.fromtimestamp(hour * 3600, timezone.utc).replace(tzinfo=EASTERN).utcoffset().total_seconds()
+               for hour in hours.tolist()]
+    return times - np.array(offsets, dtype=np.int64)[index]
+
+
+def empty():
+    """Return Bars with no bars."""
+    return Bars(*(np.empty(0, dtype=dtype) for dtype in COLUMNS.values()))
+
+
+class BarStore:
+    """Per-symbol columnar bar files under directory, limited to retention seconds of bars and maxbytes in all."""
+
+    def __init__(self, directory=BAR_DIR, retention=BAR_RETENTION_DAYS * 86400, maxbytes=BAR_MAX_BYTES):
+        self.directory = directory
+        self.retention = retention
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._current = set()
+        self._bytes = None
+        self._stats = dict.fromkeys(["appended", "replaced", "duplicates", "rewrites", "expired", "evicted", "upgraded"], 0)
+
+    def append(self, symbol, bars):
+        """
+        Store bars of symbol's, in any order. A bar at the latest stored
+        timestamp replaces the stored one, since that minute may still have
+        been forming; earlier timestamps already stored are ignored.
+        """
+
+        symbol = symbol.upper()
+        order = np.argsort(bars.time, kind="stable")
+        bars = Bars(*(column[order] for column in bars))
+
+        with self._lock:
+            stored = self._read(symbol)
+            cutoff = int(time.time() - self.retention)
+
+            # Keep the newest bar of each timestamp, and none past retention
+            last = np.r_[bars.time[1:] != bars.time[:-1], True]
+            keep = last & (bars.time >= cutoff)
+            self._stats["expired"] += int(np.count_nonzero(last & ~keep))
+            bars = Bars(*(column[keep] for column in bars))
+
+            # New bars are nearly always later than every stored one, and are appended;
+            # anything else means rewriting the symbol's files in order
+            if not len(stored.time) or not len(bars.time) or bars.time[0] > stored.time[-1]:
+                self._write(symbol, bars, "ab")
+            else:
+                # The latest stored bar is overwritten in place, where every memory map of it sees the change
+                latest = np.flatnonzero(bars.time == stored.time[-1])
+                if len(latest):
+                    self._replace_last(symbol, stored, Bars(*(column[latest] for column in bars)))
+                new = ~np.isin(bars.time, stored.time)
+                self._stats["duplicates"] += int(np.count_nonzero(~new)) - len(latest)
+                bars = Bars(*(column[new] for column in bars))
+                if len(bars.time) and bars.time[0] > stored.time[-1]:
+                    self._write(symbol, bars, "ab")
+                elif len(bars.time):
+                    merged = Bars(*(np.concatenate([old, added]) for old, added in zip(stored, bars)))
+                    order = np.argsort(merged.time, kind="stable")
+                    self._rewrite(symbol, Bars(*(column[order] for column in merged)))
+            self._stats["appended"] += len(bars.time)
+
+            # Drop expired bars once a day's worth has built up, so appends rarely rewrite
+            if len(stored.time) and stored.time[0] < cutoff - 86400:
+                stored = self._read(symbol)
+                start = np.searchsorted(stored.time, cutoff)
+                self._stats["expired"] += int(start)
+                self._rewrite(symbol, Bars(*(np.array(column[start:]) for column in stored)))
+
+            # Mark when the symbol was last seen upstream, even if no bar was new
+            self._touch(symbol)
+            self._limit(symbol)
+
+    def read(self, symbol, start=None, end=None):
+        """Return symbol's Bars with timestamps from start up to but excluding end, as read-only memory maps."""
+
+        with self._lock:
+            bars = self._read(symbol.upper())
+        lo = 0 if start is None else np.searchsorted(bars.time, start)
+        hi = len(bars.time) if end is None else np.searchsorted(bars.time, end)
+        return Bars(*(column[lo:hi] for column in bars))
+
+    def latest(self, symbol, max_age=None):
+        """Return a quote of symbol's last stored close, or None if there is none or it was stored over max_age seconds ago."""
+
+        symbol = symbol.upper()
+        path = self._path(symbol, "time")
+        try:
+            if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+                return None
+        except OSError:
+            return None
+        close = self.read(symbol).close
+        if not len(close):
+            return None
+        return {"price": float(close[-1]), "symbol": symbol}
+
+    def symbols(self):
+        """Return sorted list of stored symbols."""
+        try:
+            return sorted(os.listdir(self.directory))
+        except OSError:
+            return []
+
+    def metrics(self):
+        """Return a snapshot of store counters."""
+        with self._lock:
+            return dict(self._stats, bytes=self._size(), symbols=len(self.symbols()))
+
+    def _path(self, symbol, column):
+        return os.path.join(self.directory, symbol, column)
+
+    def _read(self, symbol):
+        """Return symbol's Bars as memory maps, reusing maps while the files keep their size. Caller holds the lock."""
+
+        # Only plain symbols name directories
+        if not symbol.replace(".", "").isalnum():
+            return empty()
+        if symbol not in self._current:
+            self._upgrade(symbol)
+        try:
+            sizes = tuple(os.path.getsize(self._path(symbol, column)) for column in COLUMNS)
+        except OSError:
+            return empty()
+        cached = self._maps.get(symbol)
+        if cached and cached[0] == sizes:
+            return cached[1]
+
+        # A reader in another process may catch a write half done, so trust only complete rows
+        length = min(size // np.dtype(dtype).itemsize for size, dtype in zip(sizes, COLUMNS.values()))
+        if not length:
+            return empty()
+        bars = Bars(*(np.memmap(self._path(symbol, column), dtype=dtype, mode="r", shape=(length,))
+                      for column, dtype in COLUMNS.items()))
+        self._maps[symbol] = (sizes, bars)
+        return bars
+
+    def _write(self, symbol, bars, mode):
+        """Write bars to symbol's column files, with mode "ab" to append or "wb" to replace. Caller holds the lock."""
+        if not symbol.replace(".", "").isalnum():
+            return
+
+        # The format file goes in before any column, so no other process takes the new files for old ones
+        if not os.path.isdir(os.path.join(self.directory, symbol)):
+            os.makedirs(os.path.join(self.directory, symbol), exist_ok=True)
+            with open(self._path(symbol, "format"), "w") as file:
+                file.write(str(FORMAT))
+            self._current.add(symbol)
+        for column, values in zip(COLUMNS, bars):
+            with open(self._path(symbol, column), mode) as file:
+                file.write(np.ascontiguousarray(values, dtype=COLUMNS[column]).tobytes())
+        if self._bytes is not None and mode == "ab":
+            self._bytes += len(bars.time) * BAR_BYTES
+        self._maps.pop(symbol, None)
+
+    def _replace_last(self, symbol, stored, bar):
+        """Overwrite the last of symbol's stored Bars with the single bar, unless they are equal. Caller holds the lock."""
+
+        if all(old[-1] == new[0] for old, new in zip(stored, bar)):
+            return
+        index = len(stored.time) - 1
+        for column, values in zip(COLUMNS, bar):
+            with open(self._path(symbol, column), "r+b") as file:
+                file.seek(index * np.dtype(COLUMNS[column]).itemsize)
+                file.write(np.ascontiguousarray(values, dtype=COLUMNS[column]).tobytes())
+        self._stats["replaced"] += 1
+
+    def _rewrite(self, symbol, bars):
+        """Replace symbol's files with bars, each file swapped in whole. Caller holds the lock."""
+        for column, values in zip(COLUMNS, bars):
+            path = self._path(symbol, column)
+            with open(path + ".tmp", "wb") as file:
+                file.write(np.ascontiguousarray(values, dtype=COLUMNS[column]).tobytes())
+            os.replace(path + ".tmp", path)
+        self._maps.pop(symbol, None)
+        self._bytes = None
+        self._stats["rewrites"] += 1
+
+    def _upgrade(self, symbol):
+        """Convert symbol's timestamps to seconds since the epoch if they are in the first layout. Caller holds the lock."""
+
+        if os.path.exists(self._path(symbol, "format")):
+            self._current.add(symbol)
+            return
+
+        # Whichever process moves the old timestamps aside converts them; the others read nothing until it is done
+        path = self._path(symbol, "time")
+        try:
+            os.rename(path, path + ".naive")
+        except OSError:
+            return
+        times = from_naive(np.fromfile(path + ".naive", dtype=np.int64))
+        with open(path + ".tmp", "wb") as file:
+            file.write(times.tobytes())
+        os.replace(path + ".tmp", path)
+        with open(self._path(symbol, "format"), "w") as file:
+            file.write(str(FORMAT))
+        os.remove(path + ".naive")
+        self._maps.pop(symbol, None)
+        self._current.add(symbol)
+        self._stats["upgraded"] += 1
+
+    def _touch(self, symbol):
+        try:
+            os.utime(self._path(symbol, "time"))
+        except OSError:
+            pass
+
+    def _size(self):
+        """Return the store's size in bytes, counting it up if unknown. Caller holds the lock."""
+        if self._bytes is None:
+            self._bytes = 0
+            for symbol in self.symbols():
+                for column in COLUMNS:
+                    try:
+                        self._bytes += os.path.getsize(self._path(symbol, column))
+                    except OSError:
+                        pass
+        return self._bytes
+
+    def _limit(self, keep):
+        """Drop the symbols updated least recently, other than keep, until the store fits in maxbytes. Caller holds the lock."""
+
+        if self._size() <= self.maxbytes:
+            return
+
+        def updated(symbol):
+            try:
+                return os.path.getmtime(self._path(symbol, "time"))
+            except OSError:
+                return 0
+
+        for symbol in sorted(self.symbols(), key=updated):
+            if self._size() <= self.maxbytes:
+                break
+            if symbol == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, symbol), ignore_errors=True)
+            self._maps.pop(symbol, None)
+            self._current.discard(symbol)
+            self._bytes = None
+            self._stats["evicted"] += 1
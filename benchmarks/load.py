@@ -0,0 +1,313 @@
+"""
+End-to-end load benchmark of every route
+
+Serves the app over HTTP from a scratch copy of finance.db, with quotes from
+a local stand-in for Alpha Vantage whose latency and error rate are set on
+the command line, and drives concurrent scripted user sessions: register,
+log out, log in, then rounds of quote, buy, index, sell, history and the
+JSON API. Reports p50/p95/p99 latency, throughput and database time per
+route, and compares them with a stored baseline, exiting with status 1 if
+any route's p95 or the overall throughput regressed by more than the
+tolerance.
+
+Usage: python benchmarks/load.py [--users N] [--rounds N] [--quote-latency MS] [--quote-errors RATE]
+                                 [--baseline PATH] [--save-baseline] [--tolerance FRACTION]
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Symbols every session trades
+SYMBOLS = ["AAPL", "AMD", "AMZN", "GOOG", "INTC", "MSFT", "NFLX", "NVDA", "ORCL", "TSLA"]
+
+# Latencies below this many milliseconds are never counted as regressions, being mostly noise
+SLACK_MS = 5
+
+
+class QuoteStub(http.server.ThreadingHTTPServer):
+    """
+    Local stand-in for Alpha Vantage's TIME_SERIES_INTRADAY and REALTIME_BULK_QUOTES CSV endpoints.
+
+    Every symbol has a fixed price. Each request is delayed by latency
+    seconds, and fails with 503 with probability errors.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, errors=0.0):
+        super().__init__(("127.0.0.1", 0), _QuoteHandler)
+        self.latency = latency
+        self.errors = errors
+        self.requests = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    @staticmethod
+    def price(symbol):
+        """Return symbol's price."""
+        return 10 + zlib.crc32(symbol.encode()) % 20000 / 100
+
+
+class _QuoteHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Replies are small writes on keep-alive connections, which Nagle's algorithm would hold back for the
+    # client's delayed ACK, adding some 40 ms to every request after the first
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        if random.random() < self.server.errors:
+            return self.reply(503, b"")
+
+        params = parse_qs(urlsplit(self.path).query)
+        function = params.get("function", [""])[0]
+        symbols = params.get("symbol", [""])[0].upper().split(",")
+        if function == "TIME_SERIES_INTRADAY":
+            price = QuoteStub.price(symbols[0])
+            body = "timestamp,open,high,low,close,volume\r\n" + "".join(
+                f"2024-01-01 10:{minute:02d}:00,{price},{price},{price},{price},100\r\n" for minute in range(59, -1, -1))
+        elif function == "REALTIME_BULK_QUOTES":
+            body = "symbol,close\r\n" + "".join(f"{symbol},{QuoteStub.price(symbol)}\r\n" for symbol in symbols)
+        else:
+            return self.reply(404, b"")
+        self.reply(200, body.encode())
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Recorder:
+    """Latencies and database time of every request, by route."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.db = {}
+        self.failures = {}
+
+    def request(self, route, seconds, ok):
+        with self.lock:
+            self.latency.setdefault(route, []).append(seconds)
+            self.failures[route] = self.failures.get(route, 0) + (not ok)
+
+    def query_time(self, route, seconds):
+        with self.lock:
+            self.db.setdefault(route, []).append(seconds)
+
+
+class Session:
+    """One user's HTTP session with the app, keeping its session cookie."""
+
+    def __init__(self, port, recorder):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        self.recorder = recorder
+        self.cookie = None
+
+    def get(self, path, **params):
+        return self.send("GET", path, params)
+
+    def post(self, path, **form):
+        return self.send("POST", path, form)
+
+    def send(self, method, path, params):
+        """Send request and record its latency under its method and path, returning the response's status."""
+
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        body = None
+        target = path
+        if method == "POST":
+            body = urlencode(params)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif params:
+            target = f"{path}?{urlencode(params)}"
+
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, target, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.recorder.request(f"{method} {path}", time.perf_counter() - start, False)
+            return None
+        self.recorder.request(f"{method} {path}", time.perf_counter() - start, response.status < 400)
+
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return response.status
+
+
+def script(port, recorder, user, rounds):
+    """Run one user's scripted session."""
+
+    session = Session(port, recorder)
+    username, password = f"load-{os.getpid()}-{user}-{random.randrange(10 ** 9)}", "password"
+    session.post("/register", username=username, password=password, confirmation=password)
+    session.get("/logout")
+    session.post("/login", username=username, password=password)
+
+    for _ in range(rounds):
+        symbol = random.choice(SYMBOLS)
+        session.post("/quote", symbol=symbol)
+        session.post("/buy", symbol=symbol, shares=random.randint(1, 2))
+        session.get("/")
+        session.get("/api/portfolio")
+        session.post("/sell", symbol=symbol, shares=1)
+        session.get("/history")
+        session.get("/api/history")
+        session.get("/api/quote", symbols=",".join(random.sample(SYMBOLS, 3)))
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values."""
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def summarize(recorder, elapsed):
+    """Return results as a dict of throughput and per route statistics, in milliseconds."""
+
+    routes = {}
+    for route, latencies in sorted(recorder.latency.items()):
+        latencies = sorted(latencies)
+        db = recorder.db.get(route, [])
+        routes[route] = {
+            "requests": len(latencies),
+            "failures": recorder.failures[route],
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "db": sum(db) / len(db) * 1000 if db else 0.0
+        }
+    requests = sum(route["requests"] for route in routes.values())
+    return {"throughput": requests / elapsed, "routes": routes}
+
+
+def report(results):
+    print(f"{'route':<20}{'requests':>9}{'failed':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db ms':>8}")
+    for route, stats in results["routes"].items():
+        print(f"{route:<20}{stats['requests']:>9}{stats['failures']:>8}{stats['p50']:>9.1f}{stats['p95']:>9.1f}"
+              f"{stats['p99']:>9.1f}{stats['db']:>8.2f}")
+    print(f"throughput {results['throughput']:.1f} requests/s")
+
+
+def regressions(results, baseline, tolerance):
+    """List how results regressed from baseline by more than tolerance, a fraction."""
+
+    found = []
+    if results["throughput"] < baseline["throughput"] * (1 - tolerance):
+        found.append(f"throughput {results['throughput']:.1f}/s, baseline {baseline['throughput']:.1f}/s")
+    for route, stats in results["routes"].items():
+        before = baseline["routes"].get(route)
+        if before and stats["p95"] > max(before["p95"] * (1 + tolerance), before["p95"] + SLACK_MS):
+            found.append(f"{route} p95 {stats['p95']:.1f} ms, baseline {before['p95']:.1f} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test every route against a local quote stub.")
+    parser.add_argument("--users", type=int, default=8, help="concurrent user sessions")
+    parser.add_argument("--rounds", type=int, default=20, help="rounds of trading per session")
+    parser.add_argument("--quote-latency", type=float, default=20, help="quote stub latency, in milliseconds")
+    parser.add_argument("--quote-errors", type=float, default=0.0, help="fraction of quote requests that fail")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="regression allowed, as a fraction")
+    args = parser.parse_args()
+    config = {key: getattr(args, key) for key in ["users", "rounds", "quote_latency", "quote_errors"]}
+
+    stub = QuoteStub(args.quote_latency / 1000, args.quote_errors)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    # The app reads its settings when imported, and finance.db from the working directory
+    os.environ.setdefault("API_KEY", "benchmark")
+    os.environ["QUOTE_PROVIDER"] = "alphavantage"
+    os.environ["QUOTE_URL"] = stub.url
+    os.environ.setdefault("QUOTE_RATE_LIMIT", "1000000")
+    os.chdir(tempfile.mkdtemp())
+    shutil.copy(os.path.join(ROOT, "finance.db"), "finance.db")
+    sys.path.insert(0, ROOT)
+    import application
+    from flask import g, request
+    from werkzeug.serving import make_server
+
+    # Time spent in the database by each request, attributed to its route
+    recorder = Recorder()
+
+    @application.app.before_request
+    def start_timing():
+        g.benchmark_db = application.db.thread_seconds()
+
+    @application.app.after_request
+    def stop_timing(response):
+        recorder.query_time(f"{request.method} {request.path}", application.db.thread_seconds() - g.benchmark_db)
+        return response
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, application.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=script, args=(server.server_port, recorder, user, args.rounds))
+               for user in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results = summarize(recorder, time.perf_counter() - start)
+    server.shutdown()
+
+    print(f"{args.users} users, {args.rounds} rounds, quotes {args.quote_latency:g} ms "
+          f"with {args.quote_errors:.0%} errors, {stub.requests} quote requests")
+    report(results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(dict(results, config=config), file, indent=4, sort_keys=True)
+        print(f"saved baseline to {args.baseline}")
+        return 0
+
+    # Only compare like with like
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare with")
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline.get("config") != config:
+        print(f"baseline was run with {baseline.get('config')}, not comparing")
+        return 0
+    found = regressions(results, baseline, args.tolerance)
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Benchmark of the P&L engine over a large history
+
+Runs against a scratch copy of finance.db seeded with one user who made
+random buys and sells of 200 symbols, 1,000,000 transactions by default,
+and times loading their history, computing the ledger, serving it from the
+cache, and bringing it up to date after one more trade.
+
+Usage: python benchmarks/pnl.py [transactions]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import Database
+from migrations import upgrade
+from pnl import LedgerCache, ledger
+from repository import History, Users
+from trades import buy
+
+
+def seed(path, transactions):
+    """Copy finance.db to path and add a benchmark user with transactions random trades, returning the user's id."""
+
+    shutil.copy(os.path.join(os.path.dirname(__file__), "..", "finance.db"), path)
+    db = Database(path)
+    upgrade(db)
+    user_id = db.execute("INSERT INTO users (username, hash) VALUES ('benchmark', '')")
+
+    # Sell at most what is held, so every sell realizes P&L
+    held = {}
+    rows = []
+    for i in range(transactions):
+        symbol = f"S{random.randrange(200)}"
+        shares = random.randint(1, 100)
+        if held.get(symbol) and random.random() < 0.4:
+            shares = -random.randint(1, held[symbol])
+        held[symbol] = held.get(symbol, 0) + shares
+        price = round(random.uniform(1, 500), 2)
+        rows.append((symbol, shares, price, abs(shares) * price, user_id, i))
+
+    with db.transaction() as connection:
+        connection.executemany("INSERT INTO history (symbol, shares, price, total, id, date_time) "
+                               "VALUES (?, ?, ?, ?, ?, datetime('2020-01-01', ? || ' seconds'))", rows)
+    return user_id
+
+
+def timed(fn, repeat=3):
+    """Return fn's result and the fastest of repeat runs, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main(transactions):
+    path = os.path.join(tempfile.mkdtemp(), "finance.db")
+    user_id = seed(path, transactions)
+    db = Database(path)
+    users, histories = Users(db), History(db)
+    cache = LedgerCache(users, histories)
+
+    columns, load = timed(lambda: histories.columns(user_id))
+    book, compute = timed(lambda: ledger(columns.codes, columns.names, columns.shares, columns.prices))
+
+    cache.get(user_id)
+    _, cached = timed(lambda: cache.get(user_id))
+    buy(db, user_id, "S0", 1, 1.0)
+    _, traded = timed(lambda: cache.get(user_id), repeat=1)
+
+    print(f"{transactions:,} transactions, {len(book.symbols)} symbols")
+    print(f"    load history  {load * 1000:10.1f} ms")
+    print(f"    ledger        {compute * 1000:10.1f} ms")
+    print(f"    cached        {cached * 1000:10.3f} ms")
+    print(f"    after trade   {traded * 1000:10.1f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,86 @@
+"""
+Microbenchmark of per-query overhead: repository methods vs. execute() vs. the CS50 Library
+
+Runs against a scratch copy of finance.db seeded with one user holding 50
+symbols and 1,000 transactions.
+
+Usage: python benchmarks/repository.py [iterations]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import Database
+from migrations import upgrade
+from repository import History, Portfolio, Users
+
+
+def seed(path):
+    """Copy finance.db to path and add a benchmark user with holdings and history, returning the user's id."""
+
+    shutil.copy(os.path.join(os.path.dirname(__file__), "..", "finance.db"), path)
+    db = Database(path)
+    upgrade(db)
+    user_id = db.execute("INSERT INTO users (username, hash) VALUES ('benchmark', '')")
+    with db.transaction() as connection:
+        connection.executemany("INSERT INTO portfolio (symbol, shares, price, total, id) VALUES (?, 10, 1.5, 15, ?)",
+                               [(f"S{i}", user_id) for i in range(50)])
+        connection.executemany("INSERT INTO history (symbol, shares, price, total, id, date_time) "
+                               "VALUES (?, 1, 1.5, 1.5, ?, datetime('2020-01-01', ? || ' minutes'))",
+                               [(f"S{i % 50}", user_id, i) for i in range(1000)])
+    return user_id
+
+
+def main(iterations):
+    path = os.path.join(tempfile.mkdtemp(), "finance.db")
+    user_id = seed(path)
+    db = Database(path)
+    users, portfolios, histories = Users(db), Portfolio(db), History(db)
+
+    cases = {
+        "user by username": {
+            "repository": lambda: users.by_username("benchmark"),
+            "execute": lambda: db.execute("SELECT * FROM users WHERE username = :username", username="benchmark"),
+            "cs50": "SELECT * FROM users WHERE username = 'benchmark'"
+        },
+        "portfolio symbols (50 rows)": {
+            "repository": lambda: portfolios.symbols(user_id),
+            "execute": lambda: db.execute("SELECT symbol FROM portfolio WHERE id=:_id", _id=user_id),
+            "cs50": f"SELECT symbol FROM portfolio WHERE id={user_id}"
+        },
+        "history page (100 rows)": {
+            "repository": lambda: histories.page(user_id, limit=100),
+            "execute": lambda: db.execute("SELECT h_id, symbol, shares, price, total, date_time FROM history WHERE id = :_id "
+                                          "ORDER BY date_time DESC, h_id DESC LIMIT 100", _id=user_id),
+            "cs50": f"SELECT h_id, symbol, shares, price, total, date_time FROM history WHERE id = {user_id} "
+                    "ORDER BY date_time DESC, h_id DESC LIMIT 100"
+        }
+    }
+
+    # The CS50 Library is no longer a dependency, so only compare against it if it is installed
+    try:
+        import logging
+        from cs50 import SQL
+        logging.getLogger("cs50").disabled = True
+        cs50 = SQL(f"sqlite:///{path}")
+    except Exception:
+        cs50 = None
+
+    for name, case in cases.items():
+        print(name)
+        runners = {"repository": case["repository"], "execute": case["execute"]}
+        if cs50:
+            runners["cs50"] = lambda sql=case["cs50"]: cs50.execute(sql)
+        for runner, fn in runners.items():
+            fn()
+            seconds = min(timeit.repeat(fn, number=iterations, repeat=3))
+            print(f"    {runner:<12}{seconds / iterations * 1e6:10.1f} µs/query")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
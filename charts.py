@@ -0,0 +1,172 @@
+"""
+Portfolio value over time
+
+A user's value is charted at evenly spaced times by replaying their history
+against stored prices, with no Python loop over times:
+
+- Holdings: each transaction's signed shares land in a (time, symbol)
+  matrix at the first chart time not before it, and a cumulative sum down
+  the time axis gives the shares held at every time. Cash is replayed the
+  same way from STARTING_CASH.
+- Prices: every symbol's known prices (stored intraday bars, the prices it
+  was traded at, and its latest quote) are searched with searchsorted for
+  the last one at or before each time, giving a matching price matrix.
+
+Value is the row sums of the two matrices' product. Charts depend on
+history, stored prices and the time they end at, so they are cached per user
+and interval until the user trades again (their version changes), the
+interval's current step ends, or the quote of a symbol they traded changes.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from collections import namedtuple
+
+from helpers import LRU, bar_store, quote_cache
+from snapshots import STARTING_CASH
+
+# Chart settings
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 1000))
+
+# Chart intervals, with the seconds between points and at most how far back they go
+INTERVALS = {
+    "day": (86400, None),
+    "hour": (3600, 30 * 86400),
+    "minute": (60, 2 * 86400)
+}
+
+# period is the number of the interval's step the chart was drawn in, and price_version the quote cache
+# version its latest quotes were read at
+Chart = namedtuple("Chart", ["version", "interval", "period", "price_version", "times", "holdings", "cash", "total"])
+
+
+def replay(times, names, codes, shares, prices, grid, priced):
+    """
+    Return values of holdings and cash at each time of grid, a sorted array of
+    seconds since the epoch, after transactions of shares at prices at times
+    (seconds since the epoch, oldest first), each in symbol names[code].
+    priced(symbol) returns a symbol's other known prices, as arrays of times
+    and prices.
+    """
+
+    codes = np.asarray(codes, dtype=np.int64)
+    times = np.asarray(times, dtype=np.int64)
+    shares = np.asarray(shares, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64)
+
+    # Transactions count from the first chart time not before them; those after the last are left out
+    rows = np.searchsorted(grid, times, side="left")
+    shown = rows < len(grid)
+    held = np.zeros((len(grid), len(names)), dtype=np.int64)
+    np.add.at(held, (rows[shown], codes[shown]), shares[shown])
+    held = np.cumsum(held, axis=0)
+    spent = np.zeros(len(grid))
+    np.add.at(spent, rows[shown], shares[shown] * prices[shown])
+    cash = STARTING_CASH - np.cumsum(spent)
+
+    # Last price known at each chart time, column by column, with transactions grouped by symbol once
+    matrix = np.zeros((len(grid), len(names)))
+    by_symbol = np.argsort(codes, kind="stable")
+    ends = np.cumsum(np.bincount(codes, minlength=len(names)))
+    for code, symbol in enumerate(names):
+        traded = by_symbol[ends[code - 1] if code else 0:ends[code]]
+        known_times, known_prices = priced(symbol)
+        observed = np.concatenate([times[traded], np.asarray(known_times, dtype=np.int64)])
+        observed_prices = np.concatenate([prices[traded], np.asarray(known_prices, dtype=np.float64)])
+        order = np.argsort(observed, kind="stable")
+        observed, observed_prices = observed[order], observed_prices[order]
+        last = np.searchsorted(observed, grid, side="right") - 1
+        matrix[:, code] = np.where(last >= 0, observed_prices[np.maximum(last, 0)], 0.0)
+
+    holdings = (held * matrix).sum(axis=1)
+    return np.round(holdings, 2), np.round(cash, 2)
+
+
+def grid(first, now, interval):
+    """Return chart times for interval, from the step containing first (or as far back as interval goes) up to now."""
+    step, span = INTERVALS[interval]
+    if span is not None:
+        first = max(first, now - span)
+    start = first // step * step + step
+    return np.append(np.arange(start, now, step, dtype=np.int64), now)
+
+
+class ChartCache:
+    """
+    Bounded LRU cache of Charts by user id and interval, valid while the
+    user's version, the interval's step and their symbols' quotes are unchanged.
+
+    Prices come from bars, a BarStore (or None), and cache, for latest quotes.
+    """
+
+    def __init__(self, users, histories, bars=bar_store, cache=quote_cache, maxsize=CHART_CACHE_SIZE):
+        self.users = users
+        self.histories = histories
+        self.bars = bars
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._charts = LRU(maxsize)
+
+    def get(self, user_id, interval="day"):
+        """Return user's Chart for interval, one of INTERVALS, redrawing it if it is out of date."""
+
+        _, version = self.users.cash(user_id)
+        now = int(time.time())
+        period = now // INTERVALS[interval][0]
+        with self._lock:
+            chart, names = self._charts.get((user_id, interval), (None, ()))
+            if chart and chart.version == version and chart.period == period:
+                changed = self.cache.changed_since(chart.price_version)
+                if changed is not None and not changed.intersection(names):
+                    return chart
+
+        chart, names = self._draw(user_id, version, interval, now)
+        with self._lock:
+            self._charts.put((user_id, interval), (chart, names))
+        return chart
+
+    def _draw(self, user_id, version, interval, now):
+        """Return user's Chart for interval, ending at now, and the symbols it prices."""
+
+        # Read the price version first, so quotes changed while drawing redraw it next time
+        price_version = self.cache.version
+        period = now // INTERVALS[interval][0]
+        times, names, codes, shares, prices = self.histories.timeline(user_id)
+        if not len(times):
+            return Chart(version, interval, period, price_version, [now], [0.0], [STARTING_CASH], [STARTING_CASH]), []
+
+        points = grid(int(times.min()), now, interval)
+        holdings, cash = replay(times, names, codes, shares, prices, points, self._priced(now))
+        return Chart(version, interval, period, price_version, points.tolist(), holdings.tolist(), cash.tolist(),
+                     np.round(holdings + cash, 2).tolist()), names
+
+    def _priced(self, now):
+        """Return function giving a symbol's stored bar closes and latest quote, as arrays of times and prices."""
+
+        def priced(symbol):
+            bars = self.bars.read(symbol) if self.bars else None
+            quote = self.cache.peek(symbol)
+            known_times = [bars.time] if bars else []
+            known_prices = [bars.close] if bars else []
+            if quote:
+                known_times.append([now])
+                known_prices.append([quote["price"]])
+            if not known_times:
+                return (), ()
+            return np.concatenate(known_times), np.concatenate(known_prices)
+        return priced
+
+
+def polyline(values, width, height):
+    """Return SVG polyline points plotting values evenly across width, scaled to fill height."""
+    values = np.asarray(values, dtype=np.float64)
+    low, high = values.min(), values.max()
+    xs = np.linspace(0, width, len(values)) if len(values) > 1 else np.array([0.0, width])
+    ys = height - (values - low) / (high - low) * height if high > low else np.full(len(values), height / 2)
+    if len(values) == 1:
+        ys = np.repeat(ys, 2)
+    return " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs, ys))
@@ -0,0 +1,205 @@
+"""
+SQLite access for finance.db
+
+Database is a drop-in replacement for the CS50 Library's SQL class that
+gives every thread its own connection to a WAL-mode database, so readers
+never wait behind an in-flight write.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+from metrics import INSTRUMENTED, statement
+
+# Connection pragmas
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", -16000))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 64 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+
+# Prepared statements kept per connection
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", 256))
+
+
+def _dict_row(cursor, row):
+    """Return row as a dict keyed by column name, like the CS50 Library."""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class _TimedConnection:
+    """Connection whose execute and executemany count each statement's time, for transactions' statements."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return self.connection.execute(sql, params)
+        finally:
+            statement(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, rows):
+        start = time.perf_counter()
+        try:
+            return self.connection.executemany(sql, rows)
+        finally:
+            statement(sql, time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class Database:
+    """
+    SQLite database with one connection per thread.
+
+    Connections are opened on a thread's first query, tuned with the SQLITE_*
+    pragmas, and closed once their thread has exited. execute() behaves like
+    the CS50 Library's SQL.execute, and transaction() runs several statements
+    as one BEGIN IMMEDIATE transaction.
+    """
+
+    def __init__(self, path, synchronous=SQLITE_SYNCHRONOUS, cache_size=SQLITE_CACHE_SIZE,
+                 mmap_size=SQLITE_MMAP_SIZE, busy_timeout=SQLITE_BUSY_TIMEOUT):
+        self.path = path
+        self.pragmas = {
+            "synchronous": synchronous,
+            "cache_size": cache_size,
+            "mmap_size": mmap_size,
+            "busy_timeout": busy_timeout
+        }
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._stats = dict.fromkeys(["opened", "closed", "queries", "query_seconds",
+                                     "transactions", "transaction_wait_seconds"], 0)
+
+        # WAL mode is a property of the database file, so it only needs setting once
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.close()
+
+    def connection(self):
+        """Return this thread's connection, opening it if need be."""
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+
+            # Autocommit mode, so transactions are only ever begun explicitly
+            connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                         timeout=self.pragmas["busy_timeout"] / 1000,
+                                         cached_statements=SQLITE_STATEMENT_CACHE)
+            connection.row_factory = _dict_row
+            for name, value in self.pragmas.items():
+                connection.execute(f"PRAGMA {name} = {value}")
+
+            with self._lock:
+                self._prune()
+                self._connections[threading.current_thread()] = connection
+                self._stats["opened"] += 1
+            self._local.connection = connection
+        return connection
+
+    def execute(self, sql, **params):
+        """
+        Execute a SQL statement with named parameters.
+
+        Returns a list of dict rows for queries, the new row's id for INSERT
+        (or None if it violated a constraint), the number of rows affected for
+        UPDATE and DELETE, and True otherwise.
+        """
+
+        start = time.perf_counter()
+        try:
+            cursor = self.connection().execute(sql, params)
+        except sqlite3.IntegrityError:
+            if sql.lstrip()[:6].upper() == "INSERT":
+                return None
+            raise
+        try:
+            if cursor.description is not None:
+                return cursor.fetchall()
+            command = sql.lstrip()[:6].upper()
+            if command == "INSERT":
+                return cursor.lastrowid
+            if command in ("UPDATE", "DELETE"):
+                return cursor.rowcount
+            return True
+        finally:
+            self._record("queries", "query_seconds", start, sql)
+
+    def query(self, sql, params=(), row_factory=None):
+        """Run a query with positional parameters and return its rows, built by row_factory(cursor, row) if given."""
+
+        start = time.perf_counter()
+        cursor = self.connection().cursor()
+        cursor.row_factory = row_factory
+        try:
+            return cursor.execute(sql, params).fetchall()
+        finally:
+            self._record("queries", "query_seconds", start, sql)
+
+    def modify(self, sql, params=()):
+        """Run an INSERT, UPDATE or DELETE with positional parameters and return its cursor."""
+
+        start = time.perf_counter()
+        try:
+            return self.connection().execute(sql, params)
+        finally:
+            self._record("queries", "query_seconds", start, sql)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed statements as one BEGIN IMMEDIATE transaction, yielding
+        this thread's connection, wrapped to time each statement if instrumented.
+        """
+
+        connection = self.connection()
+        start = time.perf_counter()
+        connection.execute("BEGIN IMMEDIATE")
+        self._record("transactions", "transaction_wait_seconds", start, "BEGIN IMMEDIATE")
+        begun = time.perf_counter()
+        try:
+            yield _TimedConnection(connection) if INSTRUMENTED else connection
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            committing = time.perf_counter()
+            connection.execute("COMMIT")
+            if INSTRUMENTED:
+                statement("COMMIT", time.perf_counter() - committing)
+        finally:
+            self._local.seconds += time.perf_counter() - begun
+
+    def thread_seconds(self):
+        """Return seconds this thread has spent running queries and waiting to begin transactions."""
+        return getattr(self._local, "seconds", 0.0)
+
+    def metrics(self):
+        """Return a snapshot of connection pool and query counters."""
+        with self._lock:
+            self._prune()
+            return dict(self._stats, open=len(self._connections))
+
+    def _record(self, counter, timer, start, sql):
+        """Count one event and the seconds elapsed since start, running statement sql."""
+        elapsed = time.perf_counter() - start
+        self._local.seconds = getattr(self._local, "seconds", 0.0) + elapsed
+        if INSTRUMENTED:
+            statement(sql, elapsed)
+        with self._lock:
+            self._stats[counter] += 1
+            self._stats[timer] += elapsed
+
+    def _prune(self):
+        """Close connections whose threads have exited. Caller holds the lock."""
+        for thread in [thread for thread in self._connections if not thread.is_alive()]:
+            self._connections.pop(thread).close()
+            self._stats["closed"] += 1
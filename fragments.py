@@ -0,0 +1,73 @@
+"""
+Cache of rendered template fragments
+
+Portfolio rows and history pages only change when their user trades or a
+price they show moves, so their rendered HTML is cached under a key naming
+the user and the data and price versions it was rendered from. Memory is
+bounded by the total length of cached fragments, least recently used first,
+and a user's fragments are dropped outright when they trade.
+"""
+
+import os
+import threading
+
+from markupsafe import Markup
+
+from helpers import LRU
+
+# Fragment cache settings
+FRAGMENT_CACHE_CHARS = int(os.getenv("FRAGMENT_CACHE_CHARS", 16 * 1024 * 1024))
+
+
+class FragmentCache:
+    """Bounded LRU cache of rendered fragments by user and key."""
+
+    def __init__(self, maxchars=FRAGMENT_CACHE_CHARS):
+        self.maxchars = maxchars
+        self._lock = threading.Lock()
+        self._fragments = LRU(maxchars, weigh=len)
+        self._keys = {}
+        self._stats = dict.fromkeys(["hits", "misses", "evictions", "invalidations"], 0)
+
+    def get(self, user_id, key, render):
+        """Return user's fragment for key, a tuple of the versions it depends on, calling render() on a miss."""
+
+        with self._lock:
+            fragment = self._fragments.get((user_id, key))
+            if fragment is not None:
+                self._stats["hits"] += 1
+                return fragment
+            self._stats["misses"] += 1
+
+        fragment = Markup(render())
+
+        # Fragments too big to ever fit are served but not kept
+        if len(fragment) > self.maxchars:
+            return fragment
+        with self._lock:
+            if (user_id, key) not in self._fragments:
+                self._keys.setdefault(user_id, set()).add(key)
+                for evicted in self._fragments.put((user_id, key), fragment):
+                    self._evict(*evicted)
+                    self._stats["evictions"] += 1
+        return fragment
+
+    def invalidate(self, user_id):
+        """Drop every fragment of user's."""
+        with self._lock:
+            for key in self._keys.pop(user_id, ()):
+                self._fragments.pop((user_id, key))
+            self._stats["invalidations"] += 1
+
+    def metrics(self):
+        """Return a snapshot of cache counters."""
+        with self._lock:
+            return dict(self._stats, fragments=len(self._fragments), chars=self._fragments.size)
+
+    def _evict(self, cache_key, fragment):
+        """Forget an evicted fragment's key. Caller holds the lock."""
+        user_id, key = cache_key
+        keys = self._keys[user_id]
+        keys.discard(key)
+        if not keys:
+            del self._keys[user_id]
@@ -1,9 +1,47 @@
-import csv
+import http.client
 import os
-import urllib.request
+import queue
+import threading
+import time
 
-from flask import redirect, render_template, request, session
-from functools import wraps
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import make_response, redirect, render_template, request, session
+from functools import partial, wraps
+from urllib.parse import urlsplit
+
+import providers
+
+from bars import BAR_DIR, BarStore
+from metrics import timed, upstream
+from scheduler import BROWSE, PORTFOLIO, REFRESH, TRADE, RateLimited
+
+
+def env_flag(name):
+    """Tell whether environment variable name is set to 1, true or yes, in any case."""
+    return os.getenv(name, "").lower() in ("1", "true", "yes")
+
+
+# Quote cache settings
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", 60))
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", 1024))
+QUOTE_CHANGE_LOG = int(os.getenv("QUOTE_CHANGE_LOG", 4096))
+
+# Concurrent lookup settings
+QUOTE_WORKERS = int(os.getenv("QUOTE_WORKERS", 8))
+QUOTE_DEADLINE = float(os.getenv("QUOTE_DEADLINE", 5))
+
+# Batch quotes need a premium Alpha Vantage key, so they are opt-in
+QUOTE_BULK = env_flag("QUOTE_BULK")
+QUOTE_BULK_SIZE = 100
+
+# Upstream HTTP client settings
+QUOTE_URL = os.getenv("QUOTE_URL", "https://www.alphavantage.co")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 8))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.25))
 
 
 def apology(message, code=400):
@@ -35,8 +73,318 @@ def login_required(f):
     return decorated_function
 
 
-def lookup(symbol):
-    """Look up quote for symbol."""
+def cache_control(**directives):
+    """
+    Decorate routes to send Cache-Control with directives, such as
+    private=True or max_age=60, in place of the default no-store.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            response = make_response(f(*args, **kwargs))
+            for directive, value in directives.items():
+                setattr(response.cache_control, directive, value)
+            return response
+        return decorated_function
+    return decorator
+
+
+class LRU:
+    """
+    Least recently used cache of up to maxsize entries, or of values whose
+    weigh(value) adds up to at most maxsize if weigh is given. Not thread-safe,
+    so callers guard it with their own lock.
+    """
+
+    def __init__(self, maxsize, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return key's value, marking it most recently used, or default."""
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def peek(self, key, default=None):
+        """Return key's value without marking it used, or default."""
+        return self._entries.get(key, default)
+
+    def put(self, key, value):
+        """Store value under key, returning the (key, value) pairs evicted to make room, least recently used first."""
+        self.pop(key)
+        self._entries[key] = value
+        self.size += self.weigh(value) if self.weigh else 1
+        evicted = []
+        while self.size > self.maxsize and self._entries:
+            evicted.append(self._entries.popitem(last=False))
+            self.size -= self.weigh(evicted[-1][1]) if self.weigh else 1
+        return evicted
+
+    def pop(self, key, default=None):
+        """Remove key, returning its value, or default."""
+        if key not in self._entries:
+            return default
+        value = self._entries.pop(key)
+        self.size -= self.weigh(value) if self.weigh else 1
+        return value
+
+    def clear(self):
+        """Remove every entry."""
+        self._entries.clear()
+        self.size = 0
+
+
+class QuoteCache:
+    """
+    Process-wide cache of quotes keyed by symbol.
+
+    Entries expire after ttl seconds and the least recently used entry is
+    evicted once maxsize symbols are cached. Concurrent misses for the same
+    symbol share a single upstream request (single-flight).
+
+    Every change of a symbol's price bumps the cache's version, and the last
+    change_log changes are kept so callers can ask which symbols changed
+    since a version they saw.
+    """
+
+    class _Flight:
+        """An upstream request that other threads may wait on."""
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, ttl=QUOTE_CACHE_TTL, maxsize=QUOTE_CACHE_SIZE, change_log=QUOTE_CHANGE_LOG):
+        self.ttl = ttl
+        self.version = 0
+        self._lock = threading.Lock()
+        self._entries = LRU(maxsize)
+        self._inflight = {}
+        self._changes = deque(maxlen=change_log)
+
+    def get(self, symbol, fetch, fresh=False):
+        """Return cached quote for symbol, calling fetch(symbol) on a miss."""
+
+        with self._lock:
+
+            # Serve unexpired entry unless caller insists on a fresh price
+            entry = self._entries.get(symbol)
+            if entry and not fresh and entry[0] > time.monotonic():
+                return entry[1]
+
+            # Join a request already in flight for this symbol, or start one
+            flight = self._inflight.get(symbol)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[symbol] = QuoteCache._Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        # Hand any error to the threads waiting on this flight too
+        try:
+            flight.result = fetch(symbol)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[symbol]
+                if flight.result is not None:
+                    self._store(symbol, flight.result)
+            flight.done.set()
+        return flight.result
+
+    def cached(self, symbol):
+        """Return unexpired quote for symbol, or None."""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            return None
+
+    def expires_in(self, symbol):
+        """Return seconds until symbol's cached quote expires, or 0 if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.peek(symbol)
+            return max(0, entry[0] - time.monotonic()) if entry else 0
+
+    def put(self, symbol, quote):
+        """Cache quote for symbol."""
+        with self._lock:
+            self._store(symbol, quote)
+
+    def peek(self, symbol):
+        """Return last known quote for symbol, even if expired, or None."""
+        with self._lock:
+            entry = self._entries.peek(symbol)
+            return entry[1] if entry else None
+
+    def changed_since(self, version):
+        """Return set of symbols whose price changed after version, or None if that is too long ago to tell."""
+        with self._lock:
+            if version < self.version - len(self._changes):
+                return None
+            symbols = set()
+            for change, symbol in reversed(self._changes):
+                if change <= version:
+                    break
+                symbols.add(symbol)
+            return symbols
+
+    def clear(self):
+        """Forget every cached quote."""
+        with self._lock:
+            self._entries.clear()
+            self._changes.clear()
+            self.version += 1
+
+    def _store(self, symbol, quote):
+        """Insert quote, evicting least recently used entries. Caller holds the lock."""
+        entry = self._entries.peek(symbol)
+        if not entry or entry[1]["price"] != quote["price"]:
+            self.version += 1
+            self._changes.append((self.version, symbol))
+        self._entries.put(symbol, (time.monotonic() + self.ttl, quote))
+
+
+class HTTPPool:
+    """
+    Thread-safe pool of keep-alive connections to one upstream host.
+
+    At most size connections are open at once; callers block until one is
+    free. A request on an idle connection the server has since closed is
+    sent again at once on a new one. Requests that otherwise fail with a
+    connection error or a 429/5xx status are retried with exponential
+    backoff, each attempt first calling acquire if given, so retries spend
+    quota like any other request.
+    """
+
+    # Bodies left unread by a handler are drained for reuse up to this size, larger ones are dropped
+    DRAIN_LIMIT = 64 * 1024
+
+    def __init__(self, url, size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        url = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.host = url.netloc
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+
+    def get(self, path, handle, acquire=None):
+        """GET path and return handle(response), raising the last error once retries run out."""
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            if acquire:
+                acquire()
+
+            with self._slots:
+                connection = None
+                try:
+                    connection, reused = self._checkout()
+                    try:
+                        connection.request("GET", path)
+                        response = connection.getresponse()
+
+                    # An idle connection may have been closed by the server meanwhile; that costs
+                    # neither backoff nor quota, so go again at once on a fresh connection
+                    except (OSError, http.client.HTTPException):
+                        if not reused:
+                            raise
+                        connection.close()
+                        connection = self._connect()
+                        connection.request("GET", path)
+                        response = connection.getresponse()
+
+                    # Retry throttled and failed responses
+                    if response.status == 429 or response.status >= 500:
+                        error = http.client.HTTPException(f"{response.status} {response.reason}")
+                        self._checkin(connection, response)
+                        continue
+
+                    result = handle(response)
+                    self._checkin(connection, response)
+                    return result
+
+                except (OSError, http.client.HTTPException) as e:
+                    error = e
+                    if connection:
+                        connection.close()
+
+                except:
+                    connection.close()
+                    raise
+
+        raise error
+
+    def _checkout(self):
+        """Return (connection, whether it was reused): an idle connection, or a new one if there is none."""
+
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _connect(self):
+        """Return a new connection, opened with the connect timeout and then switched to the read timeout."""
+        connection = self.connection_class(self.host, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def _checkin(self, connection, response):
+        """Return connection to the pool if its response can be finished cheaply."""
+
+        if not response.isclosed() and (response.length is None or response.length > self.DRAIN_LIMIT):
+            connection.close()
+            return
+        response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self._idle.put(connection)
+
+
+# Shared by every request thread in this process
+http_pool = HTTPPool(QUOTE_URL)
+bar_store = BarStore(BAR_DIR) if BAR_DIR else None
+quote_provider = providers.create(providers.QUOTE_PROVIDER, http_pool, bar_store)
+quote_cache = QuoteCache()
+quote_pool = ThreadPoolExecutor(max_workers=QUOTE_WORKERS, thread_name_prefix="lookup")
+
+
+@timed("quote")
+def lookup(symbol, fresh=False, priority=BROWSE):
+    """
+    Look up quote for symbol.
+
+    Quotes are served from the shared quote cache, or from the bar store if
+    it was updated within QUOTE_CACHE_TTL (e.g. by another process); pass
+    fresh=True to bypass both (e.g. when executing a trade). Cache misses wait for
+    upstream quota at the given scheduler priority and raise RateLimited if
+    none frees up in time. Unknown symbols return None.
+    """
 
     # Reject symbol if it starts with caret
     if symbol.startswith("^"):
@@ -46,37 +394,94 @@ def lookup(symbol):
     if "," in symbol:
         return None
 
-    # Query Alpha Vantage for quote
-    # https://www.alphavantage.co/documentation/
-    try:
+    symbol = symbol.upper()
+    if bar_store and not fresh and quote_cache.cached(symbol) is None:
+        quote = bar_store.latest(symbol, QUOTE_CACHE_TTL)
+        if quote:
+            quote_cache.put(symbol, quote)
+            return quote
 
-        # GET CSV
-        url = f"https://www.alphavantage.co/query?apikey={os.getenv('API_KEY')}&datatype=csv&function=TIME_SERIES_INTRADAY&interval=1min&symbol={symbol}"
-        webpage = urllib.request.urlopen(url)
+    return quote_cache.get(symbol, partial(_fetch_quote, priority=priority), fresh=fresh)
 
-        # Parse CSV
-        datareader = csv.reader(webpage.read().decode("utf-8").splitlines())
 
-        # Ignore first row
-        next(datareader)
+@timed("quote")
+def lookup_many(symbols, fresh=False, stale=False, deadline=QUOTE_DEADLINE, priority=PORTFOLIO):
+    """
+    Look up quotes for several symbols in as few upstream requests as possible.
 
-        # Parse second row
-        row = next(datareader)
+    Returns (quotes, errors): quotes maps each resolved (uppercased) symbol to
+    its quote and errors maps each unresolved symbol to a short reason. Misses
+    are fetched in batches when QUOTE_BULK is enabled, otherwise concurrently
+    one symbol per request, and abandoned after deadline seconds. With
+    stale=True, unresolved symbols are also given their last known quote.
+    """
+
+    quotes = {}
+    errors = {}
+
+    # Serve what we can from the cache
+    misses = []
+    for symbol in dict.fromkeys(symbol.upper() for symbol in symbols):
+        if not symbol or symbol.startswith("^") or "," in symbol:
+            errors[symbol] = "invalid symbol"
+            continue
+        quote = None if fresh else quote_cache.cached(symbol)
+        if quote:
+            quotes[symbol] = quote
+        else:
+            misses.append(symbol)
 
-        # Ensure stock exists
+    # Fetch misses over the bounded worker pool
+    if QUOTE_BULK:
+        futures = {}
+        for i in range(0, len(misses), QUOTE_BULK_SIZE):
+            batch = misses[i:i + QUOTE_BULK_SIZE]
+            future = quote_pool.submit(_fetch_bulk, batch, priority)
+            futures.update((symbol, future) for symbol in batch)
+    else:
+        futures = {symbol: quote_pool.submit(lookup, symbol, fresh, priority) for symbol in misses}
+    done, _ = wait(set(futures.values()), timeout=deadline)
+
+    # Late fetches keep running in the background and still warm the cache
+    for symbol, future in futures.items():
+        if future not in done:
+            errors[symbol] = "timed out"
+            continue
         try:
-            price = float(row[4])
-        except:
-            return None
+            quote = future.result()
+        except RateLimited:
+            errors[symbol] = "rate limited"
+            continue
+        if QUOTE_BULK:
+            quote = quote.get(symbol)
+        if quote:
+            quotes[symbol] = quote
+        else:
+            errors[symbol] = "not found"
 
-        # Return stock's name (as a str), price (as a float), and (uppercased) symbol (as a str)
-        return {
-            "price": price,
-            "symbol": symbol.upper()
-        }
+    # Fall back to last known quotes if asked to
+    if stale:
+        for symbol in errors:
+            quote = quote_cache.peek(symbol) or (bar_store and bar_store.latest(symbol))
+            if quote:
+                quotes[symbol] = quote
 
-    except:
-        return None
+    return quotes, errors
+
+
+@timed("upstream", upstream)
+def _fetch_bulk(symbols, priority=PORTFOLIO):
+    """Query the quote provider for quotes of up to QUOTE_BULK_SIZE symbols at once, caching them."""
+    quotes = quote_provider.bulk(symbols, priority)
+    for symbol, quote in quotes.items():
+        quote_cache.put(symbol, quote)
+    return quotes
+
+
+@timed("upstream", upstream)
+def _fetch_quote(symbol, priority=BROWSE):
+    """Query the quote provider for quote, bypassing the cache."""
+    return quote_provider.quote(symbol, priority)
 
 
 def usd(value):
@@ -0,0 +1,222 @@
+"""
+Per-request timing and Prometheus metrics
+
+With METRICS or SERVER_TIMING set, each request's time is split into
+phases: sql (every statement, sessions' included), quote (waiting on
+lookups), upstream (quote provider requests made by the request's own
+thread, within quote), session (loading and saving the session) and render
+(Jinja). Phases nest, so they need not add up to the total.
+
+METRICS serves every phase, statement and request as a histogram at
+/metrics, along with the counters of the app's caches and pools.
+SERVER_TIMING adds a Server-Timing header of the request's phases, for
+browser developer tools.
+
+With both unset, timed() returns functions undecorated and nothing else is
+hooked in, so instrumentation costs nothing.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+from flask import before_render_template, template_rendered
+from functools import lru_cache, wraps
+
+# Instrumentation settings
+METRICS = os.getenv("METRICS", "").lower() in ("1", "true", "yes")
+SERVER_TIMING = os.getenv("SERVER_TIMING", "").lower() in ("1", "true", "yes")
+METRICS_BUCKETS = tuple(float(bound) for bound in os.getenv(
+    "METRICS_BUCKETS", "0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10").split(","))
+INSTRUMENTED = METRICS or SERVER_TIMING
+
+# Longest SQL kept whole as a statement label; longer SQL is cut short and tagged with a hash of the whole
+STATEMENT_LABEL_CHARS = 80
+
+
+class Histogram:
+    """Thread-safe Prometheus histogram of seconds, one series per tuple of label values."""
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, seconds, *values):
+        """Count an observation of seconds under label values."""
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        """Return the histogram in Prometheus text format, as a list of lines."""
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((values, ([*counts], total, count)) for values, (counts, total, count) in self._series.items())
+        for values, (counts, total, count) in series:
+            labels = list(zip(self.labels, values))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{_labels(labels + [('le', f'{bound:g}')])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    """Histograms, and functions returning dicts of counters to be served as gauges."""
+
+    def __init__(self):
+        self.histograms = []
+        self.sources = {}
+
+    def histogram(self, name, help, labels=()):
+        """Return a new Histogram, served with the registry."""
+        histogram = Histogram(name, help, labels)
+        self.histograms.append(histogram)
+        return histogram
+
+    def source(self, prefix, metrics):
+        """Serve the numbers in the dict metrics() returns as gauges named finance_<prefix>_<key>."""
+        self.sources[prefix] = metrics
+
+    def render(self):
+        """Return every metric in Prometheus text format."""
+
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        for prefix, metrics in self.sources.items():
+            for key, value in sorted(metrics().items()):
+                if isinstance(value, (int, float)):
+                    name = f"finance_{prefix}_{key}"
+                    lines.extend([f"# TYPE {name} gauge", f"{name} {value:g}"])
+        return "\n".join(lines) + "\n"
+
+
+# Shared by every thread
+registry = Registry()
+requests = registry.histogram("finance_request_seconds", "Time to handle a request.", ("route", "method", "status"))
+phases = registry.histogram("finance_request_phase_seconds", "Time spent by a request in each phase.", ("route", "phase"))
+statements = registry.histogram("finance_sql_seconds", "Time to run a SQL statement.", ("statement",))
+upstream = registry.histogram("finance_quote_upstream_seconds", "Time of a request to the quote provider.")
+renders = registry.histogram("finance_render_seconds", "Time to render a template.", ("template",))
+
+# Phase times of the request being handled by this thread
+_local = threading.local()
+
+
+def record(phase, seconds):
+    """Add seconds to the current request's phase, if the thread is handling one."""
+    timings = getattr(_local, "phases", None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+def label(route):
+    """Name the route the current request matched."""
+    _local.route = route
+
+
+def timed(phase, histogram=None):
+    """Decorate a function to add its time to phase, and to histogram if given, unless instrumentation is off."""
+
+    def decorator(fn):
+        if not INSTRUMENTED:
+            return fn
+
+        @wraps(fn)
+        def timed_fn(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                record(phase, elapsed)
+                if histogram:
+                    histogram.observe(elapsed)
+        return timed_fn
+    return decorator
+
+
+def statement(sql, seconds):
+    """Count a SQL statement taking seconds."""
+    statements.observe(seconds, _statement_label(sql))
+    record("sql", seconds)
+
+
+@lru_cache(maxsize=1024)
+def _statement_label(sql):
+    """Return sql with its whitespace normalized, shortened to STATEMENT_LABEL_CHARS plus a hash if longer."""
+    text = " ".join(sql.split())
+    if len(text) <= STATEMENT_LABEL_CHARS:
+        return text
+    return f"{text[:STATEMENT_LABEL_CHARS]}... {hashlib.sha1(text.encode()).hexdigest()[:8]}"
+
+
+class Instrumented:
+    """
+    WSGI middleware timing every request to app, from before its session is
+    loaded to after it is saved, optionally reporting its phases in a Server-Timing
+    header. Templates' render times come from Flask's signals.
+    """
+
+    def __init__(self, app):
+        self.wsgi_app = app.wsgi_app
+        before_render_template.connect(self._rendering, app)
+        template_rendered.connect(self._rendered, app)
+
+    def __call__(self, environ, start_response):
+        _local.phases = {}
+        _local.route = "unmatched"
+        start = time.perf_counter()
+
+        def timed_start_response(status, headers, exc_info=None):
+            _local.status = status.split(" ", 1)[0]
+            if SERVER_TIMING:
+                timings = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in _local.phases.items()]
+                timings.append(f"total;dur={(time.perf_counter() - start) * 1000:.1f}")
+                headers.append(("Server-Timing", ", ".join(timings)))
+            return start_response(status, headers, exc_info)
+
+        # Streamed bodies are produced after this returns, and so aren't counted
+        try:
+            return self.wsgi_app(environ, timed_start_response)
+        finally:
+            route = _local.route
+            requests.observe(time.perf_counter() - start, route, environ["REQUEST_METHOD"], getattr(_local, "status", ""))
+            for phase, seconds in _local.phases.items():
+                phases.observe(seconds, route, phase)
+            _local.phases = None
+            _local.status = ""
+
+    def _rendering(self, sender, template, context, **extra):
+        _local.renders = getattr(_local, "renders", [])
+        _local.renders.append(time.perf_counter())
+
+    def _rendered(self, sender, template, context, **extra):
+        elapsed = time.perf_counter() - _local.renders.pop()
+        renders.observe(elapsed, template.name or "")
+        record("render", elapsed)
+
+
+def _labels(pairs):
+    """Return Prometheus label set of (name, value) pairs, or "" if there are none."""
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
@@ -0,0 +1,140 @@
+"""
+Versioned schema migrations for finance.db
+
+The schema version is kept in SQLite's user_version pragma. Each migration's
+version is its position in MIGRATIONS, starting at 1, so new migrations are
+only ever appended. Migrations must be safe to rerun, in case one fails
+part way through.
+
+Usage: python migrations.py [--check]
+"""
+
+import sqlite3
+import sys
+
+from database import Database
+
+# Hot per-user queries whose plans must not scan their table
+CHECKED_QUERIES = [
+    "SELECT symbol, shares, price, total, date_time FROM history WHERE id = 1 ORDER BY date_time",
+    "SELECT symbol, shares, price FROM portfolio WHERE id = 1",
+    "SELECT shares FROM portfolio WHERE id = 1 AND symbol = 'AAPL'"
+]
+
+
+def numeric_portfolio_values(db):
+    """
+    Convert USD strings such as "$1,234.56" in portfolio and history price/total columns to numbers.
+
+    Safe to run repeatedly, rows that already hold numbers are left alone.
+    """
+    for table in ["portfolio", "history"]:
+        for column in ["price", "total"]:
+            db.execute(f"UPDATE {table} SET {column} = CAST(REPLACE(REPLACE({column}, '$', ''), ',', '') AS REAL) "
+                       f"WHERE typeof({column}) = 'text'")
+
+
+def history_user_index(db):
+    """Index history by user and time, for /history."""
+    db.execute("CREATE INDEX IF NOT EXISTS history_id_date_time ON history (id, date_time)")
+
+
+def portfolio_user_symbol_index(db):
+    """Merge duplicate holdings, then allow one portfolio row per user and symbol, for /, /buy and /sell."""
+
+    # Fold duplicates into the oldest row
+    db.execute("UPDATE portfolio SET "
+               "shares = (SELECT SUM(shares) FROM portfolio p WHERE p.id = portfolio.id AND p.symbol = portfolio.symbol), "
+               "total = price * (SELECT SUM(shares) FROM portfolio p WHERE p.id = portfolio.id AND p.symbol = portfolio.symbol) "
+               "WHERE p_id IN (SELECT MIN(p_id) FROM portfolio GROUP BY id, symbol HAVING COUNT(*) > 1)")
+    db.execute("DELETE FROM portfolio WHERE p_id NOT IN (SELECT MIN(p_id) FROM portfolio GROUP BY id, symbol)")
+
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS portfolio_id_symbol ON portfolio (id, symbol)")
+
+
+def sessions_table(db):
+    """Store server-side sessions, shared by every worker process."""
+    db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY NOT NULL, data BLOB NOT NULL, expiry REAL NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)")
+
+
+def users_version(db):
+    """Count changes to each user's cash and holdings, so every worker can tell when its cached view is stale."""
+    columns = [row["name"] for row in db.execute("SELECT name FROM pragma_table_info('users')")]
+    if "version" not in columns:
+        db.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+
+def quota_table(db):
+    """Keep the upstream quote quota's token bucket, shared by every worker process."""
+    db.execute("CREATE TABLE IF NOT EXISTS quota (name TEXT PRIMARY KEY NOT NULL, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+
+# Applied in order, never reorder or remove entries
+MIGRATIONS = [
+    numeric_portfolio_values,
+    history_user_index,
+    portfolio_user_symbol_index,
+    sessions_table,
+    users_version,
+    quota_table
+]
+
+
+def schema_version(db):
+    """Return version of the schema in db."""
+    return db.execute("SELECT user_version FROM pragma_user_version")[0]["user_version"]
+
+
+def upgrade(db):
+    """
+    Apply every migration newer than db's schema version, returning the new version.
+
+    Each migration and its version bump run as one BEGIN IMMEDIATE
+    transaction, and the version is read again once the lock is held, so
+    workers starting together apply each migration exactly once.
+    """
+
+    version = schema_version(db)
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        with db.transaction():
+            version = schema_version(db)
+            if number > version:
+                migration(db)
+                db.execute(f"PRAGMA user_version = {number}")
+                version = number
+    return version
+
+
+def query_plans(path):
+    """Return EXPLAIN QUERY PLAN details for each of CHECKED_QUERIES against database at path."""
+    connection = sqlite3.connect(path)
+    try:
+        return {query: [row[-1] for row in connection.execute(f"EXPLAIN QUERY PLAN {query}")]
+                for query in CHECKED_QUERIES}
+    finally:
+        connection.close()
+
+
+def check(path):
+    """Print query plans before and after upgrading database at path, returning whether any table scans remain."""
+
+    before = query_plans(path)
+    upgrade(Database(path))
+    after = query_plans(path)
+
+    scans = False
+    for query in CHECKED_QUERIES:
+        print(query)
+        print(f"    before: {'; '.join(before[query])}")
+        print(f"    after:  {'; '.join(after[query])}")
+        scans = scans or any(detail.startswith("SCAN") for detail in after[query])
+    return scans
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        sys.exit(1 if check("finance.db") else 0)
+    print(f"schema version {upgrade(Database('finance.db'))}")
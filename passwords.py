@@ -0,0 +1,180 @@
+"""
+Password hashing off the request thread
+
+Hashing is deliberately slow, so it runs in a small pool of worker
+processes instead of on request threads, where a burst of logins would hold
+the GIL and stall every other route. At most PASSWORD_QUEUE_LIMIT hashes may
+be queued or running at once; beyond that PasswordsBusy is raised, so a
+burst is turned away rather than queued for ever.
+"""
+
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+# Password hashing settings; the method is werkzeug's, with its cost, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", os.cpu_count() or 1))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", 64))
+PASSWORD_TIMEOUT = float(os.getenv("PASSWORD_TIMEOUT", 30))
+
+
+class PasswordsBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed, or one took longer than the timeout."""
+
+
+def _full_method(method):
+    """
+    Return werkzeug hash method with werkzeug's default for any cost left
+    out, as it appears in the hashes it makes, e.g. scrypt:32768:8:1 for scrypt.
+    """
+    name, *args = method.split(":")
+    if name == "scrypt" and not args:
+        return "scrypt:32768:8:1"
+    if name == "pbkdf2" and len(args) < 2:
+        return f"pbkdf2:{args[0] if args else 'sha256'}:{DEFAULT_PBKDF2_ITERATIONS}"
+    if name not in ("scrypt", "pbkdf2"):
+        raise ValueError(f"unknown password hash method {method!r}")
+    return method
+
+
+def _timed(fn, *args):
+    """Call fn(*args) in a worker process, returning its result and when it started and finished."""
+    start = time.time()
+    result = fn(*args)
+    return result, start, time.time()
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords in a process pool, started on first use.
+
+    hash() uses method, and needs_rehash() tells whether a stored hash was
+    made with another method or cost, to be upgraded by rehash() once its
+    password is known to be right.
+    """
+
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_WORKERS, queue_limit=PASSWORD_QUEUE_LIMIT,
+                 timeout=PASSWORD_TIMEOUT):
+        self.method = _full_method(method)
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self._pool = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(["hashes", "checks", "rehashes", "rejected", "timeouts", "broken",
+                                     "wait_seconds", "hash_seconds"], 0)
+        self._stats["max_pending"] = 0
+
+    def hash(self, password):
+        """Return a hash of password, made with method."""
+        return self._run("hashes", generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        """Return whether password matches pwhash."""
+        return self._run("checks", check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Return whether pwhash was made with a method or cost other than method."""
+        return pwhash.split("$", 1)[0] != self.method
+
+    def rehash(self, password, save):
+        """Hash password with method in the background, then call save(hash), unless the pool is busy."""
+        try:
+            future = self._submit(generate_password_hash, password, self.method)
+        except PasswordsBusy:
+            return
+        future.add_done_callback(lambda future: self._finish("rehashes", future, save))
+
+    def metrics(self):
+        """Return a snapshot of hashing counters and timings."""
+        with self._lock:
+            return dict(self._stats, pending=self._pending)
+
+    def _run(self, counter, fn, *args):
+        """
+        Run fn(*args) in the pool, waiting for its result, raising PasswordsBusy if it takes over timeout seconds.
+
+        A pool broken by a worker process dying is replaced and the call tried once more.
+        """
+        for attempt in range(2):
+            future = None
+            try:
+                future = self._submit(fn, *args)
+                result, start, end = future.result(timeout=self.timeout)
+                break
+            except BrokenProcessPool:
+                if future is not None:
+                    self._discard(future.pool)
+                if attempt:
+                    raise
+            except TimeoutError:
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                raise PasswordsBusy()
+        self._record(counter, future, start, end)
+        return result
+
+    def _submit(self, fn, *args):
+        """Queue fn(*args) in the pool, raising PasswordsBusy if queue_limit calls are already pending."""
+
+        with self._lock:
+            if self._pending >= self.queue_limit:
+                self._stats["rejected"] += 1
+                raise PasswordsBusy()
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self._pending += 1
+            self._stats["max_pending"] = max(self._stats["max_pending"], self._pending)
+            pool = self._pool
+
+        submitted = time.time()
+        try:
+            future = pool.submit(_timed, fn, *args)
+        except BrokenProcessPool:
+            self._discard(pool)
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.submitted = submitted
+        future.pool = pool
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._discard(future.pool)
+
+    def _discard(self, pool):
+        """Replace pool, broken by a worker dying, with a new one on next use, unless that already happened."""
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self._stats["broken"] += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _finish(self, counter, future, save):
+        """Record a background call and pass its result to save."""
+        if not future.cancelled() and future.exception() is None:
+            result, start, end = future.result()
+            self._record(counter, future, start, end)
+            save(result)
+
+    def _record(self, counter, future, start, end):
+        """Count one call, the seconds it waited in the queue and the seconds it took."""
+        with self._lock:
+            self._stats[counter] += 1
+            self._stats["wait_seconds"] += max(start - future.submitted, 0)
+            self._stats["hash_seconds"] += end - start
+
+
+# Shared by every request thread
+hasher = PasswordHasher()
@@ -0,0 +1,208 @@
+"""
+Cost basis and profit and loss over a user's history
+
+A user's history is loaded as NumPy columns and every symbol is processed at
+once, with no Python loop over transactions:
+
+- FIFO: bought shares are laid end to end, symbol by symbol, on one axis, so
+  the cost of the first x shares bought is a piecewise linear function of x
+  found by searchsorted. The shares sold by each transaction are a range on
+  that axis, and its cost is the difference of the function at each end.
+- Average cost: each buy adds its cost to the position's cost basis and each
+  sell scales the basis by the shares left, a linear recurrence whose terms
+  are summed in log space with np.logaddexp.accumulate, so long runs of
+  partial sells cannot underflow.
+
+Realized P&L depends on history alone, so it is cached per user and version
+(bumped by every trade), after which only newer transactions are loaded, and
+only unrealized P&L is recomputed at current prices.
+
+The first ledger of a user in each process still reads their whole history
+out of SQLite, which for a million transactions takes over a second: short
+of the sub-second target, with most of it spent building each row's Python
+values. Later requests are served from the cache.
+"""
+
+import os
+import threading
+
+from collections import namedtuple
+
+import numpy as np
+
+from helpers import LRU
+
+# P&L settings; the cache holds at most PNL_CACHE_ROWS transactions in all, at about 24 bytes each
+PNL_CACHE_ROWS = int(os.getenv("PNL_CACHE_ROWS", 4000000))
+
+# Log-space decay marking where a position closes or a new symbol starts, so
+# nothing earlier carries into the cost basis (exp(-1000) is 0 in float64)
+_RESET = -1000.0
+
+Position = namedtuple("Position", ["symbol", "shares", "price", "value",
+                                   "fifo_cost", "fifo_realized", "fifo_unrealized",
+                                   "average_cost", "average_realized", "average_unrealized"])
+
+# Per symbol columns computed from history alone
+Ledger = namedtuple("Ledger", ["symbols", "shares", "last_price", "fifo_cost", "fifo_realized",
+                               "average_cost", "average_realized"])
+
+
+def ledger(codes, names, shares, prices):
+    """
+    Return Ledger of each symbol's position, cost basis and realized P&L
+    under FIFO and average cost, given a history's columns oldest first,
+    with each transaction's symbol given as its index in names.
+
+    Sells are negative shares. Sells of more shares than are held only
+    realize P&L on the shares that were held.
+    """
+
+    codes = np.asarray(codes, dtype=np.int64)
+    names = np.asarray(names)
+    if not len(codes):
+        empty = np.zeros(0)
+        return Ledger(names[:0], np.zeros(0, dtype=np.int64), empty, empty, empty, empty, empty)
+
+    # Group transactions by symbol, keeping time order within each symbol; NumPy radix sorts
+    # 16 bit integers, several times faster than sorting 64 bit ones
+    order = np.argsort(codes.astype(np.uint16) if len(names) <= 1 << 16 else codes, kind="stable")
+    symbols = codes[order]
+    shares = np.asarray(shares, dtype=np.int64)[order]
+    prices = np.asarray(prices, dtype=np.float64)[order]
+    changes = np.r_[True, symbols[1:] != symbols[:-1]]
+    starts = np.flatnonzero(changes)
+    ends = np.r_[starts[1:], len(symbols)] - 1
+
+    # Number the groups from 0
+    codes = np.cumsum(changes) - 1
+    bought = np.where(shares > 0, shares, 0)
+
+    # Shares held after each transaction, never below zero: the running net shares less their
+    # running minimum, each symbol shifted below the last so the minimum restarts with it
+    net = _grouped_cumsum(shares, starts, codes)
+    shift = codes * (np.abs(shares).sum() * 2 + 1)
+    held = net - np.minimum(np.minimum.accumulate(net - shift) + shift, 0)
+
+    # Running shares bought and sold within each symbol, sells capped at the shares held
+    cumulative_bought = _grouped_cumsum(bought, starts, codes)
+    cumulative_sold = cumulative_bought - held
+    sold = np.diff(cumulative_sold, prepend=0)
+    sold[starts] = cumulative_sold[starts]
+    proceeds = sold * prices
+
+    # FIFO: cost of the shares each sell takes off the front of the symbol's buys, on an axis
+    # where every symbol's bought shares follow the previous symbol's
+    offsets = np.cumsum(bought) - cumulative_bought
+    lots = bought > 0
+    lot_ends = np.cumsum(bought[lots])
+    lot_costs = np.cumsum(bought[lots] * prices[lots])
+    lot_prices = prices[lots]
+
+    def fifo_cost(x):
+        """Cost of the first x shares on the axis of every symbol's buys."""
+        if not len(lot_ends):
+            return np.zeros(len(x))
+        lot = np.minimum(np.searchsorted(lot_ends, x), len(lot_ends) - 1)
+        return lot_costs[lot] - (lot_ends[lot] - x) * lot_prices[lot]
+
+    sold_cost = fifo_cost(offsets + cumulative_sold)
+    sold_cost_before = np.r_[0, sold_cost[:-1]]
+    sold_cost_before[starts] = fifo_cost(offsets[starts])
+    fifo_realized = proceeds - (sold_cost - sold_cost_before)
+    fifo_basis = fifo_cost(offsets[ends] + cumulative_bought[ends]) - sold_cost[ends]
+
+    # Average cost: basis[t] = ratio[t] * basis[t - 1] + cost[t], with ratio = held after / held before
+    held_before = held + sold - bought
+    sells = sold > 0
+    log_ratio = np.zeros(len(held))
+    with np.errstate(divide="ignore"):
+        log_ratio[sells] = np.maximum(np.log(held[sells] / held_before[sells]), _RESET)
+        log_ratio[starts] = _RESET
+        decay = np.cumsum(log_ratio)
+        log_cost = np.log(bought * prices)
+        average_basis = np.exp(decay + np.logaddexp.accumulate(log_cost - decay))
+    average_before = np.r_[0, average_basis[:-1]]
+    average_before[starts] = 0
+    average_realized = np.where(sells, proceeds - (average_before - average_basis), 0.0)
+
+    # Round to cents, dropping the error summing in log space leaves
+    return Ledger(names[symbols[starts]], held[ends], prices[ends], _cents(fifo_basis),
+                  _cents(np.add.reduceat(fifo_realized, starts)), _cents(average_basis[ends]),
+                  _cents(np.add.reduceat(average_realized, starts)))
+
+
+def _cents(values):
+    """Round values to cents, turning the -0.0 left by rounding small losses into 0.0."""
+    return np.round(values, 2) + 0.0
+
+
+def _grouped_cumsum(values, starts, codes):
+    """Cumulative sum of values restarting at each group's start."""
+    total = np.cumsum(values)
+    return total - (total[starts] - values[starts])[codes]
+
+
+def positions(book, prices):
+    """
+    List a Position per symbol in Ledger book, valued at prices, a dict of
+    symbol to price, or at its last traded price when missing.
+    """
+
+    current = np.array([prices.get(symbol, last) for symbol, last in zip(book.symbols.tolist(), book.last_price.tolist())],
+                       dtype=np.float64)
+    value = book.shares * current
+    columns = [book.symbols.tolist(), book.shares.tolist(), current.tolist(), value.tolist(),
+               book.fifo_cost.tolist(), book.fifo_realized.tolist(), _cents(value - book.fifo_cost).tolist(),
+               book.average_cost.tolist(), book.average_realized.tolist(), _cents(value - book.average_cost).tolist()]
+    return [Position._make(row) for row in zip(*columns)]
+
+
+def totals(positions):
+    """Return dict of each Position column summed over positions, except symbol and price."""
+    return {field: sum(getattr(position, field) for position in positions)
+            for field in Position._fields if field not in ("symbol", "shares", "price")}
+
+
+# Columns of a user's history loaded so far, with the Ledger computed from them
+_Loaded = namedtuple("_Loaded", ["version", "last_id", "names", "codes", "shares", "prices", "book"])
+
+
+class LedgerCache:
+    """
+    LRU cache of Ledgers by user id, valid while the user's version is
+    unchanged, bounded by the transactions loaded for them in all.
+
+    History is only ever appended to, so after a trade only the transactions
+    newer than those already loaded are read before recomputing.
+    """
+
+    def __init__(self, users, histories, maxrows=PNL_CACHE_ROWS):
+        self.users = users
+        self.histories = histories
+        self._lock = threading.Lock()
+        self._loaded = LRU(maxrows, weigh=lambda loaded: max(1, len(loaded.codes)))
+
+    def get(self, user_id):
+        """Return user's Ledger, recomputing it from history if they traded since it was cached."""
+
+        _, version = self.users.cash(user_id)
+        with self._lock:
+            loaded = self._loaded.get(user_id)
+            if loaded and loaded.version == version:
+                return loaded.book
+        if loaded is None:
+            loaded = _Loaded(None, 0, [], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), None)
+
+        # Number new transactions' symbols after those already seen
+        new = self.histories.columns(user_id, after=loaded.last_id, names=loaded.names)
+        codes = np.concatenate([loaded.codes, new.codes])
+        shares = np.concatenate([loaded.shares, new.shares])
+        prices = np.concatenate([loaded.prices, new.prices])
+        book = ledger(codes, new.names, shares, prices)
+        last_id = int(new.keys.max()) if len(new.keys) else loaded.last_id
+        loaded = _Loaded(version, last_id, new.names, codes, shares, prices, book)
+
+        with self._lock:
+            self._loaded.put(user_id, loaded)
+        return book
@@ -0,0 +1,286 @@
+"""
+Quote providers
+
+lookup() gets its quotes from one provider, chosen by QUOTE_PROVIDER:
+
+- alphavantage: live quotes from Alpha Vantage, sharing its quota through
+  the scheduler. Needs API_KEY. With QUOTE_RECORD set, every bar received is
+  also appended to QUOTE_REPLAY_DIR/<SYMBOL>.csv. Given a bar store, it
+  reads the whole intraday series and keeps every bar in the store.
+- replay: serves the bars recorded in QUOTE_REPLAY_DIR, one per lookup of
+  a symbol, oldest first and round again. Symbols without a file are unknown.
+- randomwalk: synthetic prices that take a random step on every lookup,
+  for load tests.
+
+The offline providers make no upstream requests and use no quota.
+"""
+
+import csv
+import http.client
+import math
+import os
+import random
+import sqlite3
+import threading
+import zlib
+
+from abc import ABC, abstractmethod
+from functools import partial
+from urllib.parse import urlencode
+
+import bars
+
+from scheduler import BROWSE, PORTFOLIO, RateLimited, scheduler
+
+# Quote provider settings
+QUOTE_PROVIDER = os.getenv("QUOTE_PROVIDER", "alphavantage").lower()
+QUOTE_REPLAY_DIR = os.getenv("QUOTE_REPLAY_DIR", "quotes")
+QUOTE_RECORD = os.getenv("QUOTE_RECORD", "").lower() in ("1", "true", "yes")
+QUOTE_RANDOM_SEED = int(os.getenv("QUOTE_RANDOM_SEED", 0))
+QUOTE_RANDOM_VOLATILITY = float(os.getenv("QUOTE_RANDOM_VOLATILITY", 0.001))
+
+# Header of Alpha Vantage's intraday CSV, as recorded
+INTRADAY_HEADER = "timestamp,open,high,low,close,volume"
+
+
+class QuoteProvider(ABC):
+    """
+    Source of quotes, each a dict of price (float) and symbol (uppercased str).
+
+    quote() returns None for unknown symbols and may raise RateLimited.
+    """
+
+    # Whether the provider needs API_KEY
+    needs_api_key = False
+
+    @abstractmethod
+    def quote(self, symbol, priority=BROWSE):
+        """Return quote for symbol, or None."""
+
+    def bulk(self, symbols, priority=PORTFOLIO):
+        """Return dict of quotes by symbol for those of symbols that are known."""
+        quotes = {}
+        for symbol in symbols:
+            quote = self.quote(symbol, priority)
+            if quote:
+                quotes[quote["symbol"]] = quote
+        return quotes
+
+
+class AlphaVantage(QuoteProvider):
+    """
+    Live quotes from Alpha Vantage, over pool and through the scheduler,
+    optionally recorded to record_dir and with their series kept in bar_store.
+    """
+
+    needs_api_key = True
+
+    def __init__(self, pool, api_key=None, record_dir=None, bar_store=None):
+        self.pool = pool
+        self.api_key = api_key
+        self.record_dir = record_dir
+        self.bar_store = bar_store
+        self._lock = threading.Lock()
+
+    def quote(self, symbol, priority=BROWSE):
+        """Query Alpha Vantage for quote, bypassing the cache."""
+
+        # Query Alpha Vantage for quote
+        # https://www.alphavantage.co/documentation/
+        try:
+
+            # GET CSV, asking for the compact (latest 100 bars) series, reading header and
+            # first data row only since the newest bar comes first, unless the bars are kept
+            if self.bar_store:
+                read = lambda webpage: webpage.read().splitlines(keepends=True)
+            else:
+                read = lambda webpage: [webpage.readline(), webpage.readline()]
+            lines = self._query(read, priority,
+                                function="TIME_SERIES_INTRADAY", interval="1min", outputsize="compact", symbol=symbol)
+
+            # Alpha Vantage answers over-quota requests with a JSON notice instead of CSV
+            if _throttled(lines[1]):
+                raise RateLimited(lines[1].decode("utf-8").strip())
+
+            # Parse CSV
+            datareader = csv.reader(line.decode("utf-8") for line in lines)
+
+            # Ignore first row
+            next(datareader)
+
+            # Parse second row
+            row = next(datareader)
+
+            # Ensure stock exists
+            try:
+                price = float(row[4])
+            except:
+                return None
+
+            if self.record_dir:
+                self._record(symbol.upper(), row)
+
+            # Keep the rest of the series, newest bar included, without letting a full disk cost the quote
+            if self.bar_store:
+                try:
+                    self.bar_store.append(symbol, bars.from_rows([row, *datareader]))
+                except OSError:
+                    pass
+
+            # Return stock's price (as a float), (uppercased) symbol (as a str) and bytes read (as an int)
+            return {
+                "price": price,
+                "symbol": symbol.upper(),
+                "bytes": sum(len(line) for line in lines)
+            }
+
+        except RateLimited:
+            raise
+
+        except:
+            return None
+
+    def bulk(self, symbols, priority=PORTFOLIO):
+        """Query Alpha Vantage for quotes of several symbols in one request."""
+
+        def parse(webpage):
+            """Parse CSV, one row per symbol found."""
+            lines = []
+            for line in webpage:
+                if _throttled(line):
+                    raise RateLimited(line.decode("utf-8").strip())
+                lines.append(line.decode("utf-8"))
+
+            quotes = {}
+            for row in csv.DictReader(lines):
+                try:
+                    symbol = row["symbol"].upper()
+                    quotes[symbol] = {
+                        "price": float(row["close"]),
+                        "symbol": symbol
+                    }
+                except:
+                    continue
+            return quotes
+
+        # https://www.alphavantage.co/documentation/#realtime-bulk-quotes
+        try:
+            return self._query(parse, priority, function="REALTIME_BULK_QUOTES", symbol=",".join(symbols))
+
+        except RateLimited:
+            raise
+
+        except:
+            return {}
+
+    def _query(self, handle, priority, **params):
+        """Send query through the connection pool, taking quota for each attempt, and return handle(response)."""
+        params = {"apikey": self.api_key or os.getenv("API_KEY"), "datatype": "csv", **params}
+        try:
+            return self.pool.get(f"/query?{urlencode(params)}", handle, partial(scheduler.acquire, priority))
+
+        # Still throttled once the pool's retries run out, or the shared quota table stayed locked:
+        # either way no quota now, rather than an unknown symbol
+        except http.client.HTTPException as e:
+            if str(e).startswith("429 "):
+                raise RateLimited(str(e)) from e
+            raise
+        except sqlite3.OperationalError as e:
+            raise RateLimited(f"quota unavailable: {e}") from e
+
+    def _record(self, symbol, row):
+        """Append bar row to symbol's file in record_dir, unless it is the bar last recorded."""
+
+        path = os.path.join(self.record_dir, f"{symbol}.csv")
+        line = ",".join(row)
+        with self._lock:
+            os.makedirs(self.record_dir, exist_ok=True)
+            last = None
+            if os.path.exists(path):
+                with open(path) as file:
+                    for last in file:
+                        pass
+            if last is not None and last.split(",", 1)[0] == row[0]:
+                return
+            with open(path, "a") as file:
+                if last is None:
+                    file.write(INTRADAY_HEADER + "\n")
+                file.write(line + "\n")
+
+
+class Replay(QuoteProvider):
+    """Bars recorded in directory, one file per symbol, served in turn."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._prices = {}
+        self._positions = {}
+
+    def quote(self, symbol, priority=BROWSE):
+        symbol = symbol.upper()
+        with self._lock:
+            if symbol not in self._prices:
+                self._prices[symbol] = self._load(symbol)
+            prices = self._prices[symbol]
+            if not prices:
+                return None
+            position = self._positions.get(symbol, 0)
+            self._positions[symbol] = (position + 1) % len(prices)
+        return {"price": prices[position], "symbol": symbol}
+
+    def _load(self, symbol):
+        """Return symbol's recorded closing prices, oldest first, or [] if none were recorded."""
+
+        # Only plain symbols name files
+        if not symbol.replace(".", "").isalnum():
+            return []
+        try:
+            with open(os.path.join(self.directory, f"{symbol}.csv")) as file:
+                rows = [row for row in csv.DictReader(file) if row.get("close")]
+        except OSError:
+            return []
+        return [float(row["close"]) for row in sorted(rows, key=lambda row: row["timestamp"])]
+
+
+class RandomWalk(QuoteProvider):
+    """
+    Synthetic quotes for any alphabetic symbol, each starting at a price
+    derived from the symbol and moving by a random step of about volatility
+    (a fraction of the price) on every lookup.
+    """
+
+    def __init__(self, seed=QUOTE_RANDOM_SEED, volatility=QUOTE_RANDOM_VOLATILITY):
+        self.volatility = volatility
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._prices = {}
+
+    def quote(self, symbol, priority=BROWSE):
+        symbol = symbol.upper()
+        if not symbol.replace(".", "").isalpha():
+            return None
+        with self._lock:
+            price = self._prices.get(symbol)
+            if price is None:
+                price = 10 + zlib.crc32(symbol.encode()) % 49000 / 100
+            else:
+                price *= math.exp(self._random.gauss(0, self.volatility))
+            self._prices[symbol] = price
+        return {"price": round(price, 2), "symbol": symbol}
+
+
+def _throttled(line):
+    """Tell whether a response line is Alpha Vantage's JSON notice that the key's quota is used up."""
+    return line.lstrip().startswith((b'"Note"', b'"Information"'))
+
+
+def create(name, pool, bar_store=None):
+    """Return the provider called name, using pool for upstream requests and keeping bars in bar_store."""
+    if name == "alphavantage":
+        return AlphaVantage(pool, record_dir=QUOTE_REPLAY_DIR if QUOTE_RECORD else None, bar_store=bar_store)
+    if name == "replay":
+        return Replay(QUOTE_REPLAY_DIR)
+    if name == "randomwalk":
+        return RandomWalk()
+    raise ValueError(f"unknown quote provider {name!r}")
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+
+from helpers import REFRESH, RateLimited, env_flag, lookup, quote_cache
+
+# Background refresh settings
+PRICE_REFRESH = env_flag("PRICE_REFRESH")
+PRICE_REFRESH_INTERVAL = float(os.getenv("PRICE_REFRESH_INTERVAL", 15))
+PRICE_REFRESH_HALF_LIFE = float(os.getenv("PRICE_REFRESH_HALF_LIFE", 300))
+
+# When each symbol was last shown to a user, shared by every request thread
+_views = {}
+_views_lock = threading.Lock()
+
+
+def record_view(symbols):
+    """Note that symbols were just shown to a user."""
+    now = time.monotonic()
+    with _views_lock:
+        for symbol in symbols:
+            _views[symbol.upper()] = now
+
+
+class PriceRefresher(threading.Thread):
+    """
+    Keep quotes of held symbols warm in the shared quote cache.
+
+    Every interval seconds, symbols held in the portfolio table whose cached
+    quote would expire before the next pass are refreshed at REFRESH
+    priority, so the refresher only spends quota interactive requests leave
+    over. Symbols held by more users and viewed more recently go first.
+    """
+
+    def __init__(self, portfolios, interval=PRICE_REFRESH_INTERVAL, half_life=PRICE_REFRESH_HALF_LIFE):
+        super().__init__(name="price-refresher", daemon=True)
+        self.portfolios = portfolios
+        self.interval = interval
+        self.half_life = half_life
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                continue
+
+    def stop(self):
+        """Stop after the current pass."""
+        self._stopped.set()
+
+    def refresh(self):
+        """Refresh due symbols in priority order until the quota runs out. Return number refreshed."""
+
+        refreshed = 0
+        for symbol in self.due():
+            try:
+                lookup(symbol, fresh=True, priority=REFRESH)
+            except RateLimited:
+                break
+            refreshed += 1
+        return refreshed
+
+    def due(self):
+        """List held symbols whose cached quote expires before the next pass, most important first."""
+
+        holders = self.portfolios.holders()
+
+        # Weigh holder count by how recently the symbol was viewed
+        now = time.monotonic()
+        with _views_lock:
+            views = dict(_views)
+        scored = []
+        for symbol, count in holders:
+            symbol = symbol.upper()
+            if quote_cache.expires_in(symbol) > self.interval:
+                continue
+            age = now - views.get(symbol, now - 10 * self.half_life)
+            scored.append((count * 2 ** (-age / self.half_life), count, symbol))
+
+        return [symbol for _, _, symbol in sorted(scored, reverse=True)]
@@ -0,0 +1,166 @@
+"""
+Named queries over finance.db
+
+Each method runs a fixed SQL string with positional parameters, so sqlite3
+prepares it once per connection and serves it from the statement cache
+afterwards, and returns rows as lightweight named tuples rather than dicts.
+"""
+
+import sqlite3
+
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+User = namedtuple("User", ["id", "username", "hash", "cash"])
+Holding = namedtuple("Holding", ["symbol", "shares", "price", "total"])
+Transaction = namedtuple("Transaction", ["h_id", "symbol", "shares", "price", "total", "date_time"])
+Columns = namedtuple("Columns", ["keys", "names", "codes", "shares", "prices"])
+
+
+def _first(cursor, row):
+    """sqlite3 row factory keeping only a row's first column."""
+    return row[0]
+
+
+# sqlite3 row factories building each row type
+_user = lambda cursor, row: User._make(row)
+_holding = lambda cursor, row: Holding._make(row)
+_transaction = lambda cursor, row: Transaction._make(row)
+
+
+class _Columns:
+    """
+    sqlite3 row factory appending rows of (key, symbol, shares, price) to
+    typed arrays, with each symbol numbered in order of first appearance after
+    names. It returns None, so a million rows leave no tuples behind for the
+    garbage collector to walk.
+    """
+
+    def __init__(self, names=()):
+        self.keys, self.codes, self.shares, self.prices = array("q"), array("q"), array("q"), array("d")
+        self.index = {name: code for code, name in enumerate(names)}
+
+    def __call__(self, cursor, row):
+        key, symbol, shares, price = row
+        self.keys.append(key)
+        self.codes.append(self.index.setdefault(symbol, len(self.index)))
+        self.shares.append(shares)
+        self.prices.append(price)
+
+    def columns(self):
+        """Return the rows read as Columns of NumPy arrays, sharing the arrays' memory."""
+        return Columns(np.frombuffer(self.keys, dtype=np.int64), list(self.index),
+                       np.frombuffer(self.codes, dtype=np.int64), np.frombuffer(self.shares, dtype=np.int64),
+                       np.frombuffer(self.prices, dtype=np.float64))
+
+
+class Users:
+    """Queries on the users table."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def by_username(self, username):
+        """Return User with username, or None."""
+        rows = self.db.query("SELECT id, username, hash, cash FROM users WHERE username = ?", (username,), _user)
+        return rows[0] if rows else None
+
+    def cash(self, user_id):
+        """Return (cash, version) for user, version counting changes to their cash and holdings."""
+        return self.db.query("SELECT cash, version FROM users WHERE id = ?", (user_id,), None)[0]
+
+    def ids(self):
+        """List every user's id."""
+        return self.db.query("SELECT id FROM users ORDER BY id", (), _first)
+
+    def set_hash(self, user_id, hash):
+        """Replace user's password hash."""
+        self.db.modify("UPDATE users SET hash = ? WHERE id = ?", (hash, user_id))
+
+    def create(self, username, hash):
+        """Insert user, returning their id, or None if username is taken."""
+        try:
+            return self.db.modify("INSERT INTO users (username, hash) VALUES (?, ?)", (username, hash)).lastrowid
+        except sqlite3.IntegrityError:
+            return None
+
+
+class Portfolio:
+    """Queries on the portfolio table."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def symbols(self, user_id):
+        """List symbols user holds."""
+        return self.db.query("SELECT symbol FROM portfolio WHERE id = ?", (user_id,), _first)
+
+    def holdings(self, user_id):
+        """List user's Holdings, valued at their stored prices."""
+        return self.db.query("SELECT symbol, shares, price, shares * price FROM portfolio WHERE id = ?",
+                             (user_id,), _holding)
+
+    def holders(self):
+        """List (symbol, number of users holding it) for every held symbol."""
+        return self.db.query("SELECT symbol, COUNT(DISTINCT id) FROM portfolio GROUP BY symbol", (), None)
+
+
+class History:
+    """Queries on the history table."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def positions(self, user_id):
+        """List (symbol, net shares, net cost) per symbol over all of user's transactions."""
+        return self.db.query("SELECT symbol, SUM(shares), SUM(shares * price) FROM history WHERE id = ? GROUP BY symbol",
+                             (user_id,), None)
+
+    def columns(self, user_id, after=0, names=()):
+        """
+        Return Columns of user's transactions after h_id after, oldest first:
+        keys are h_ids, and codes index symbols in names, which extends the
+        names given with any symbols new to them.
+        """
+        rows = _Columns(names)
+        self.db.query("SELECT h_id, symbol, shares, price FROM history WHERE id = ? AND h_id > ? ORDER BY date_time, h_id",
+                      (user_id, after), rows)
+        return rows.columns()
+
+    def timeline(self, user_id):
+        """Return Columns of all user's transactions, oldest first, keyed by their times in seconds since the epoch."""
+        rows = _Columns()
+        self.db.query("SELECT CAST(strftime('%s', date_time) AS INTEGER), symbol, shares, price FROM history "
+                      "WHERE id = ? ORDER BY date_time, h_id", (user_id,), rows)
+        return rows.columns()
+
+    def page(self, user_id, symbol=None, start=None, end=None, before=None, limit=100):
+        """
+        List up to limit of user's Transactions, newest first.
+
+        Filters by symbol and by date range (YYYY-MM-DD, inclusive) are
+        optional, and before=(date_time, h_id) continues from the key a
+        previous page ended at. Each combination of filters is its own fixed
+        statement, so every one stays prepared.
+        """
+
+        clauses = ["id = ?"]
+        params = [user_id]
+        if symbol:
+            clauses.append("symbol = ?")
+            params.append(symbol)
+        if start:
+            clauses.append("date_time >= ?")
+            params.append(start)
+        if end:
+            clauses.append("date_time < date(?, '+1 day')")
+            params.append(end)
+        if before:
+            clauses.append("(date_time, h_id) < (?, ?)")
+            params.extend(before)
+        params.append(limit)
+
+        return self.db.query(f"SELECT h_id, symbol, shares, price, total, date_time FROM history WHERE {' AND '.join(clauses)} "
+                             "ORDER BY date_time DESC, h_id DESC LIMIT ?", params, _transaction)
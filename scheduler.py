@@ -0,0 +1,154 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Upstream quota settings
+QUOTE_RATE_LIMIT = float(os.getenv("QUOTE_RATE_LIMIT", 5))
+QUOTE_RATE_PERIOD = float(os.getenv("QUOTE_RATE_PERIOD", 60))
+QUOTE_TRADE_RESERVE = int(os.getenv("QUOTE_TRADE_RESERVE", 1))
+QUOTE_REFRESH_RESERVE = int(os.getenv("QUOTE_REFRESH_RESERVE", 2))
+
+# Priority classes, lower runs first
+TRADE = 0
+PORTFOLIO = 1
+BROWSE = 2
+REFRESH = 3
+
+# Longest a request of each class waits for quota, in seconds
+MAX_WAIT = {
+    TRADE: 10,
+    PORTFOLIO: 5,
+    BROWSE: 3,
+    REFRESH: 0
+}
+
+
+class RateLimited(Exception):
+    """Raised when the upstream quota is exhausted."""
+
+
+class TokenBucket:
+    """Token bucket holding up to capacity tokens, refilled at rate tokens per second. Not thread-safe."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, reserve=0):
+        """Take a token, leaving at least reserve behind. Return 0 on success, otherwise seconds until possible."""
+
+        # Refill for the time elapsed
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= reserve + 1:
+            self.tokens -= 1
+            return 0
+        return (reserve + 1 - self.tokens) / self.rate
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket kept in db's quota table under name, so every worker process
+    spends the same tokens. Each take is one BEGIN IMMEDIATE transaction, and
+    time is wall-clock time, which every process shares.
+    """
+
+    def __init__(self, db, name, capacity, rate):
+        self.db = db
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+
+    def take(self, reserve=0):
+        """Take a token, leaving at least reserve behind. Return 0 on success, otherwise seconds until possible."""
+
+        with self.db.transaction() as connection:
+            now = time.time()
+            row = connection.execute("SELECT tokens, updated FROM quota WHERE name = ?", (self.name,)).fetchone()
+            tokens = self.capacity
+            if row:
+                tokens = min(self.capacity, row["tokens"] + max(0, now - row["updated"]) * self.rate)
+
+            wait = 0
+            if tokens >= reserve + 1:
+                tokens -= 1
+            else:
+                wait = (reserve + 1 - tokens) / self.rate
+            connection.execute("INSERT INTO quota (name, tokens, updated) VALUES (?, ?, ?) "
+                               "ON CONFLICT (name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                               (self.name, tokens, now))
+            return wait
+
+
+class Scheduler:
+    """
+    Admit upstream requests in priority order within the token bucket's quota.
+
+    Requests below TRADE priority leave trade_reserve tokens in the bucket, so
+    portfolio refreshes and quote browsing cannot starve trade execution.
+    Background REFRESH requests leave a further refresh_reserve tokens for
+    interactive requests.
+
+    The bucket starts out private to the process; share() moves it into the
+    database, so the quota holds however many worker processes serve the app.
+    Priority order is kept within each process only.
+    """
+
+    def __init__(self, limit=QUOTE_RATE_LIMIT, period=QUOTE_RATE_PERIOD, trade_reserve=QUOTE_TRADE_RESERVE,
+                 refresh_reserve=QUOTE_REFRESH_RESERVE):
+        self.bucket = TokenBucket(limit, limit / period)
+        self.reserve = {
+            TRADE: 0,
+            PORTFOLIO: trade_reserve,
+            BROWSE: trade_reserve,
+            REFRESH: trade_reserve + refresh_reserve
+        }
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def share(self, db, name="quote"):
+        """Keep the bucket in db from now on, shared with every process that does the same."""
+        with self._cond:
+            self.bucket = SharedTokenBucket(db, name, self.bucket.capacity, self.bucket.rate)
+
+    def acquire(self, priority, timeout=None):
+        """Wait for quota at priority, raising RateLimited if none frees up within timeout seconds."""
+
+        if timeout is None:
+            timeout = MAX_WAIT.get(priority, 0)
+        deadline = time.monotonic() + timeout
+        reserve = self.reserve.get(priority, 0)
+
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+
+                    # Only the most urgent waiter may take a token
+                    wait = None
+                    if self._waiting[0] == ticket:
+                        wait = self.bucket.take(reserve)
+                        if not wait:
+                            return
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RateLimited("upstream quote quota exhausted")
+                    self._cond.wait(min(wait, remaining) if wait else remaining)
+
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+
+# Shared by every request thread in this process
+scheduler = Scheduler()
@@ -0,0 +1,102 @@
+"""
+Server-side sessions stored in finance.db
+
+Every worker process shares the same sessions table, so login state
+survives whichever worker handles the next request. Reads are cached in
+memory for a few seconds, and expired sessions are garbage collected on
+read, every SESSION_CLEANUP_N_REQUESTS requests on average, and by
+`flask session-cleanup`.
+"""
+
+import os
+import threading
+import time
+
+from flask_session.base import ServerSideSessionInterface
+
+from helpers import LRU
+from metrics import timed
+
+# Session store settings
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 2))
+SESSION_CLEANUP_N_REQUESTS = int(os.getenv("SESSION_CLEANUP_N_REQUESTS", 1000))
+
+
+class SQLiteSessionInterface(ServerSideSessionInterface):
+    """
+    Flask-Session interface keeping sessions in the sessions table.
+
+    Another worker's changes to a session can take up to cache_ttl seconds
+    to be seen here, so keep cache_ttl short.
+    """
+
+    # SQLite has no TTL of its own, so Flask-Session should schedule cleanups
+    ttl = False
+
+    def __init__(self, app, db, cache_size=SESSION_CACHE_SIZE, cache_ttl=SESSION_CACHE_TTL,
+                 cleanup_n_requests=SESSION_CLEANUP_N_REQUESTS, **kwargs):
+        self.db = db
+        self.cache_ttl = cache_ttl
+        self._cache = LRU(cache_size)
+        self._lock = threading.Lock()
+        super().__init__(app, cleanup_n_requests=cleanup_n_requests, **kwargs)
+
+    @timed("session")
+    def open_session(self, app, request):
+        return super().open_session(app, request)
+
+    @timed("session")
+    def save_session(self, app, session, response):
+        return super().save_session(app, session, response)
+
+    def _retrieve_session_data(self, store_id):
+        """Return session data for store_id, or None if it is missing or expired."""
+
+        # Serve recent reads from memory
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(store_id)
+            if entry and entry[0] > now and entry[1] > now:
+                return dict(entry[2])
+
+        rows = self.db.query("SELECT data, expiry FROM sessions WHERE id = ?", (store_id,))
+        if not rows:
+            return None
+
+        # Delete expired session as soon as it is seen
+        data, expiry = rows[0]
+        if expiry <= now:
+            self._delete_session(store_id)
+            return None
+
+        data = self.serializer.decode(data)
+        self._remember(store_id, expiry, data)
+        return dict(data)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        """Save session, to expire session_lifetime from now."""
+        expiry = time.time() + session_lifetime.total_seconds()
+        self.db.modify("INSERT INTO sessions (id, data, expiry) VALUES (?, ?, ?) "
+                       "ON CONFLICT (id) DO UPDATE SET data = excluded.data, expiry = excluded.expiry",
+                       (store_id, self.serializer.encode(session), expiry))
+        self._remember(store_id, expiry, dict(session))
+
+    def _delete_session(self, store_id):
+        """Delete session."""
+        self.db.modify("DELETE FROM sessions WHERE id = ?", (store_id,))
+        with self._lock:
+            self._cache.pop(store_id, None)
+
+    def cleanup(self):
+        """Delete every expired session, returning how many there were."""
+        return self.db.modify("DELETE FROM sessions WHERE expiry <= ?", (time.time(),)).rowcount
+
+    def _delete_expired_sessions(self):
+        """Delete every expired session."""
+        self.cleanup()
+
+    def _remember(self, store_id, expiry, data):
+        """Cache session data for cache_ttl seconds, evicting least recently used entries."""
+        with self._lock:
+            self._cache.put(store_id, (time.time() + self.cache_ttl, expiry, data))
@@ -0,0 +1,229 @@
+"""
+Per-user holdings and valuation snapshots
+
+The index page used to rebuild a user's whole portfolio from the tables on
+every request. A snapshot keeps it in memory instead: trades made by this
+process are applied to it incrementally, and price changes only re-value the
+holdings whose quote moved since the snapshot was last valued.
+
+Snapshots are per process, so each one records the user's version (bumped
+by every trade, in the users table). A single primary key read per request
+tells whether another worker has traded since, in which case the snapshot is
+rebuilt from the tables.
+"""
+
+import os
+import threading
+
+from collections import OrderedDict, namedtuple
+
+from helpers import LRU, quote_cache
+from repository import Holding
+
+# Snapshot settings
+SNAPSHOT_CACHE_SIZE = int(os.getenv("SNAPSHOT_CACHE_SIZE", 10000))
+
+# Cash each user starts with, the users table's default
+STARTING_CASH = float(os.getenv("STARTING_CASH", 10000))
+
+# Largest difference in cash treated as rounding by check()
+CASH_TOLERANCE = 0.005
+
+# price_version is the quote cache version when a held stock's price last changed, for cache keys and
+# ETags; checked is the quote cache version the holdings were last re-priced at
+Snapshot = namedtuple("Snapshot", ["version", "price_version", "checked", "cash", "holdings", "total"])
+
+
+def _valued(version, price_version, checked, cash, holdings):
+    """Return Snapshot of cash and holdings, a dict of symbol to Holding, with their grand total."""
+    return Snapshot(version, price_version, checked, cash, holdings,
+                    cash + sum(holding.total for holding in holdings.values()))
+
+
+class SnapshotStore:
+    """
+    Bounded LRU cache of Snapshots by user id.
+
+    Snapshots are immutable and replaced whole, so a reader never sees one
+    half updated.
+    """
+
+    def __init__(self, users, portfolios, histories, cache=quote_cache, maxsize=SNAPSHOT_CACHE_SIZE):
+        self.users = users
+        self.portfolios = portfolios
+        self.histories = histories
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._snapshots = LRU(maxsize)
+        self._stats = dict.fromkeys(["hits", "rebuilds", "revalued", "applied"], 0)
+
+    def get(self, user_id):
+        """Return user's Snapshot, valued at the latest cached quotes."""
+
+        _, version = self.users.cash(user_id)
+        with self._lock:
+            snapshot = self._snapshots.get(user_id)
+
+        # Rebuild if another worker traded since, otherwise re-price what moved
+        if snapshot is None or snapshot.version != version:
+            snapshot = self.rebuild(user_id)
+        else:
+            snapshot = self.revalue(snapshot)
+            self._count("hits")
+
+        self._remember(user_id, snapshot)
+        return snapshot
+
+    def rebuild(self, user_id):
+        """Build user's Snapshot from the users and portfolio tables."""
+
+        # Read the price version first, so changes made while building are re-priced next time
+        price_version = self.cache.version
+
+        # Retry if a trade lands between reading cash and holdings
+        cash, version = self.users.cash(user_id)
+        while True:
+            rows = self.portfolios.holdings(user_id)
+            current = self.users.cash(user_id)
+            if current[1] == version:
+                break
+            cash, version = current
+
+        holdings = OrderedDict()
+        for holding in rows:
+            holdings[holding.symbol] = self._priced(holding)
+
+        self._count("rebuilds")
+        return _valued(version, price_version, price_version, cash, holdings)
+
+    def revalue(self, snapshot):
+        """
+        Return snapshot valued at the latest cached quotes, re-pricing only
+        holdings whose quote changed. Its price_version only moves on if one
+        of their prices did.
+        """
+
+        checked = self.cache.version
+        if checked == snapshot.checked:
+            return snapshot
+
+        # Everything may have changed if the change log no longer reaches back far enough
+        changed = self.cache.changed_since(snapshot.checked)
+        if changed is None:
+            changed = snapshot.holdings.keys()
+
+        holdings = OrderedDict(snapshot.holdings)
+        moved = False
+        for symbol in changed:
+            if symbol in holdings:
+                holdings[symbol] = self._priced(holdings[symbol])
+                moved = moved or holdings[symbol] != snapshot.holdings[symbol]
+                self._count("revalued")
+
+        if not moved:
+            return snapshot._replace(checked=checked)
+        return _valued(snapshot.version, checked, checked, snapshot.cash, holdings)
+
+    def apply_trade(self, user_id, version, symbol, shares, price):
+        """
+        Apply a trade of shares (negative when selling) at price to user's
+        snapshot, version being the user's version after the trade.
+
+        Snapshots that missed an earlier trade are dropped, to be rebuilt.
+        """
+
+        with self._lock:
+            snapshot = self._snapshots.get(user_id)
+            if snapshot is None or snapshot.version != version - 1:
+                self._snapshots.pop(user_id, None)
+                return
+
+            self._snapshots.put(user_id, self._traded(snapshot, version, symbol, shares, price))
+            self._stats["applied"] += 1
+
+    def discard(self, user_id):
+        """Forget user's snapshot."""
+        with self._lock:
+            self._snapshots.pop(user_id, None)
+
+    def check(self, user_id):
+        """
+        Compare user's holdings and cash as replayed from history against
+        the tables, a snapshot rebuilt from them, one built up by applying
+        every trade in history in turn, and the cached snapshot if this
+        process has one, returning a list of mismatches.
+
+        The cached snapshot is dropped either way, so the next request rebuilds it.
+        """
+
+        expected = {}
+        spent = 0
+        for symbol, shares, cost in self.histories.positions(user_id):
+            spent += cost
+            if shares:
+                expected[symbol] = shares
+        expected_cash = STARTING_CASH - spent
+
+        cash, _ = self.users.cash(user_id)
+        stored = {holding.symbol: holding.shares for holding in self.portfolios.holdings(user_id)}
+        with self._lock:
+            snapshot = self._snapshots.pop(user_id, None)
+
+        # Build snapshots the ways requests do
+        rebuilt = self.rebuild(user_id)
+        applied = _valued(0, 0, 0, STARTING_CASH, OrderedDict())
+        columns = self.histories.columns(user_id)
+        trades = zip(columns.codes.tolist(), columns.shares.tolist(), columns.prices.tolist())
+        for version, (code, shares, price) in enumerate(trades, start=1):
+            applied = self._traded(applied, version, columns.names[code], shares, price)
+
+        mismatches = []
+        sources = [("tables", cash, stored)]
+        for source, built in [("rebuilt snapshot", rebuilt), ("applied snapshot", applied), ("cached snapshot", snapshot)]:
+            if built is not None:
+                sources.append((source, built.cash, {symbol: holding.shares for symbol, holding in built.holdings.items()}))
+        for source, actual_cash, actual in sources:
+            if abs(actual_cash - expected_cash) > CASH_TOLERANCE:
+                mismatches.append(f"user {user_id} {source}: cash {actual_cash:.2f}, history says {expected_cash:.2f}")
+            for symbol in sorted(set(expected) | set(actual)):
+                if expected.get(symbol, 0) != actual.get(symbol, 0):
+                    mismatches.append(f"user {user_id} {source}: {actual.get(symbol, 0)} {symbol}, "
+                                      f"history says {expected.get(symbol, 0)}")
+        return mismatches
+
+    def metrics(self):
+        """Return a snapshot of cache counters."""
+        with self._lock:
+            return dict(self._stats, cached=len(self._snapshots))
+
+    def _traded(self, snapshot, version, symbol, shares, price):
+        """Return snapshot after a trade of shares (negative when selling) at price, as of user version."""
+
+        # Trades store their price on the holding, like the portfolio table
+        holdings = OrderedDict(snapshot.holdings)
+        held = holdings.get(symbol)
+        remaining = (held.shares if held else 0) + shares
+        if remaining:
+            holdings[symbol] = self._priced(Holding(symbol, remaining, price, remaining * price))
+        else:
+            holdings.pop(symbol, None)
+        return _valued(version, snapshot.price_version, snapshot.checked, snapshot.cash - shares * price, holdings)
+
+    def _priced(self, holding):
+        """Return holding valued at its cached quote, or at its stored price if there is none."""
+        quote = self.cache.peek(holding.symbol)
+        if quote is None or quote["price"] == holding.price:
+            return holding
+        return holding._replace(price=quote["price"], total=holding.shares * quote["price"])
+
+    def _remember(self, user_id, snapshot):
+        """Cache snapshot unless a newer one is already cached, evicting least recently used entries."""
+        with self._lock:
+            cached = self._snapshots.peek(user_id)
+            if cached is not None and (cached.version, cached.checked) > (snapshot.version, snapshot.checked):
+                return
+            self._snapshots.put(user_id, snapshot)
+
+    def _count(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
@@ -0,0 +1,66 @@
+"""
+Trade execution
+
+Each buy or sell runs as a single BEGIN IMMEDIATE transaction, so its cash
+check, portfolio change, history entry and cash update commit together (one
+fsync) and concurrent trades by the same user cannot interleave. Every trade
+bumps the user's version, which is returned.
+"""
+
+
+class TradeError(Exception):
+    """Raised when a trade is refused, with a message and HTTP status for the apology."""
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+def buy(database, user_id, symbol, shares, price):
+    """Buy shares of symbol at price for user, raising TradeError if user can't afford them. Return user's new version."""
+
+    cost = price * shares
+    with database.transaction() as db:
+
+        # Take the cost only if the user has enough cash
+        if not db.execute("UPDATE users SET cash = cash - ?, version = version + 1 WHERE id = ? AND cash >= ?",
+                          (cost, user_id, cost)).rowcount:
+            raise TradeError("insufficient funds", 403)
+
+        # Add to existing holding, or start a new one
+        db.execute("INSERT INTO portfolio (symbol, shares, price, total, id) VALUES (?, ?, ?, ?, ?) "
+                   "ON CONFLICT (id, symbol) DO UPDATE SET shares = shares + excluded.shares, price = excluded.price, "
+                   "total = (shares + excluded.shares) * excluded.price",
+                   (symbol, shares, price, cost, user_id))
+
+        db.execute("INSERT INTO history (symbol, shares, price, total, id) VALUES (?, ?, ?, ?, ?)",
+                   (symbol, shares, price, cost, user_id))
+
+        return db.execute("SELECT version FROM users WHERE id = ?", (user_id,)).fetchone()["version"]
+
+
+def sell(database, user_id, symbol, shares, price):
+    """Sell shares of symbol at price for user, raising TradeError if user doesn't hold that many. Return user's new version."""
+
+    revenue = price * shares
+    with database.transaction() as db:
+
+        # Take the shares only if the user holds enough of them
+        if not db.execute("UPDATE portfolio SET shares = shares - ?, price = ?, total = (shares - ?) * ? "
+                          "WHERE id = ? AND symbol = ? AND shares >= ?",
+                          (shares, price, shares, price, user_id, symbol, shares)).rowcount:
+            if db.execute("SELECT 1 FROM portfolio WHERE id = ? AND symbol = ?", (user_id, symbol)).fetchone():
+                raise TradeError("quantity of shares are insufficient")
+            raise TradeError("stock is not in portfolio", 403)
+
+        # If no shares of stock are owned, delete stock data from portfolio
+        db.execute("DELETE FROM portfolio WHERE id = ? AND symbol = ? AND shares = 0", (user_id, symbol))
+
+        # Add transaction into history, outgoing transactions are negative
+        db.execute("INSERT INTO history (symbol, shares, price, total, id) VALUES (?, ?, ?, ?, ?)",
+                   (symbol, -shares, price, revenue, user_id))
+
+        db.execute("UPDATE users SET cash = cash + ?, version = version + 1 WHERE id = ?", (revenue, user_id))
+
+        return db.execute("SELECT version FROM users WHERE id = ?", (user_id,)).fetchone()["version"]